@@ -0,0 +1,328 @@
+# This file is part of the vck distribution: get the rest from
+# http://www.cl.cam.ac.uk/~fms27/vck/
+#
+# Benchmarks for the primitives of the kit. Each case runs, for each size,
+# in a fresh child process, so that its peak memory can be measured on its
+# own; the time reported is the best of a few runs. Results can be saved as
+# JSON and compared with those of an earlier run to spot regressions. Run
+# it with --help for the options.
+
+import vck
+import sys
+import os
+import time
+import json
+import fnmatch
+import platform
+import resource
+import tempfile
+import shutil
+import argparse
+import multiprocessing
+import numpy
+from PIL import Image
+
+
+# The cases. Each one is a function that takes the side of a square picture
+# in pixels and a scratch directory and prepares whatever the operation
+# needs, returning a pair made of the function to be timed (taking no
+# arguments) and the number of pixels it processes.
+
+def caseLoadPBM(side, tmp):
+    name = os.path.join(tmp, "load.pbm")
+    vck.randomBitmap((side, side), "bench").write(name)
+    return (lambda: vck.bitmap(name)), side*side
+
+def caseLoadTIFF(side, tmp):
+    name = os.path.join(tmp, "load.tif")
+    vck.randomBitmap((side, side), "bench").write(name)
+    return (lambda: vck.bitmap(name)), side*side
+
+def caseMapPBM(side, tmp):
+    name = os.path.join(tmp, "map.pbm")
+    vck.randomBitmap((side, side), "bench").write(name)
+    return (lambda: vck.mapBitmap(name).buffer().sum()), side*side
+
+def caseSavePBM(side, tmp):
+    b = vck.randomBitmap((side, side), "bench")
+    return (lambda: b.write(os.path.join(tmp, "save.pbm"))), side*side
+
+def caseSaveTIFF(side, tmp):
+    b = vck.randomBitmap((side, side), "bench")
+    return (lambda: b.write(os.path.join(tmp, "save.tif"))), side*side
+
+def caseXOR(side, tmp):
+    a = vck.randomBitmap((side, side), "a")
+    b = vck.randomBitmap((side, side), "b")
+    return (lambda: vck.XOR(a, b)), side*side
+
+def caseOR3(side, tmp):
+    a = vck.randomBitmap((side, side), "a")
+    b = vck.randomBitmap((side, side), "b")
+    c = vck.randomBitmap((side, side), "c")
+    return (lambda: vck.OR(a, b, c)), side*side
+
+def caseNOT(side, tmp):
+    a = vck.randomBitmap((side, side), "a")
+    return (lambda: vck.NOT(a)), side*side
+
+def casePixelcode(side, tmp):
+    a = vck.randomBitmap((side, side), "a")
+    return (lambda: a.pixelcode()), side*side
+
+def casePixelcodeNaorShamir(side, tmp):
+    a = vck.randomBitmap((side, side), "a")
+    scheme = vck.naorShamirScheme("bench")
+    return (lambda: a.pixelcode(scheme)), side*side
+
+def caseRandomBitmap(side, tmp):
+    return (lambda: vck.randomBitmap((side, side))), side*side
+
+def caseRandomBitmapSeeded(side, tmp):
+    return (lambda: vck.randomBitmap((side, side), "bench")), side*side
+
+def caseEncrypt(side, tmp):
+    plaintext = vck.randomBitmap((side, side), "p")
+    pad = vck.randomBitmap((side, side), "k")
+    return (lambda: vck.encrypt(plaintext, pad)), side*side
+
+def caseEncryptFused(side, tmp):
+    plaintext = vck.randomBitmap((side, side), "p")
+    pad = vck.randomBitmap((side, side), "k")
+    return (lambda: vck.encryptFused(plaintext, pad)), side*side
+
+def caseUpdate(side, tmp):
+    # A 100x20 field changes, as on a form that is filled in afresh.
+    raw = os.path.join(tmp, "rawpad.pbm")
+    coded = os.path.join(tmp, "coded.pbm")
+    vck.makePadStream((side, side), None, raw)
+    previous = vck.randomBitmap((side, side), "p")
+    vck.makeCryptograph(previous, coded, raw)
+    plaintext = vck.NOT(previous)
+    box = (side//4, side//4, min(side, side//4 + 100), min(side, side//4 + 20))
+    pixels = (box[2] - box[0]) * (box[3] - box[1])
+    return (lambda: vck.updateCryptograph(plaintext, coded, raw, [box])), pixels
+
+def caseDecrypt(side, tmp):
+    ciphertext, pad = vck.encrypt(vck.randomBitmap((side, side), "p"))
+    return (lambda: vck.decrypt(ciphertext, pad)), side*side
+
+def caseMoonfieldFill(side, tmp):
+    mf = vck.moonfield((side, side))
+    return (lambda: mf.fill(lambda xs, ys: xs + ys, 1)), side*side
+
+def caseMoonfieldRandomFill(side, tmp):
+    mf = vck.moonfield((side, side))
+    return (lambda: mf.randomFill()), side*side
+
+def caseImageComplement(side, tmp):
+    pad = vck.moonfield((side, side))
+    pad.randomFill(seed="bench")
+    image = Image.new("L", (side, side), 128)
+    return (lambda: pad.imageComplement(image)), side*side
+
+def caseWritePS(side, tmp):
+    mf = vck.moonfield((side, side))
+    mf.randomFill(seed="bench")
+    return (lambda: mf.write(os.path.join(tmp, "mf.ps"))), side*side
+
+def caseWritePDF(side, tmp):
+    mf = vck.moonfield((side, side))
+    mf.randomFill(seed="bench")
+    return (lambda: mf.write(os.path.join(tmp, "mf.pdf"))), side*side
+
+def colourPicture(side):
+    """Return a colour picture with something in every channel."""
+
+    ramp = Image.linear_gradient("L").resize((side, side))
+    return Image.merge("RGB", [ramp, ramp.rotate(90),
+                               Image.new("L", (side, side), 128)])
+
+def caseColourSeparate(side, tmp):
+    image = colourPicture(side)
+    return (lambda: vck.colourSeparate(image)), side*side
+
+def caseColourEncrypt(side, tmp):
+    channels = vck.colourSeparate(colourPicture(side), "threshold")
+    return (lambda: vck.encryptColour(channels)), side*side
+
+def caseColourImage(side, tmp):
+    channels, pad = vck.encryptColour(
+        vck.colourSeparate(colourPicture(side), "threshold"))
+    return (lambda: vck.colourImage(channels)), side*side
+
+def caseColourSplit(side, tmp):
+    image = colourPicture(side)
+    return (lambda: vck.splitImageColour(
+        image, os.path.join(tmp, "share1.png"),
+        os.path.join(tmp, "share2.png"))), side*side
+
+cases = [
+    ("bitmap.load.pbm", caseLoadPBM),
+    ("bitmap.load.tif", caseLoadTIFF),
+    ("bitmap.map.pbm", caseMapPBM),
+    ("bitmap.write.pbm", caseSavePBM),
+    ("bitmap.write.tif", caseSaveTIFF),
+    ("boolean.XOR2", caseXOR),
+    ("boolean.OR3", caseOR3),
+    ("boolean.NOT", caseNOT),
+    ("pixelcode.diagonal", casePixelcode),
+    ("pixelcode.naorshamir", casePixelcodeNaorShamir),
+    ("randomBitmap.urandom", caseRandomBitmap),
+    ("randomBitmap.seeded", caseRandomBitmapSeeded),
+    ("encrypt", caseEncrypt),
+    ("encryptFused", caseEncryptFused),
+    ("updateCryptograph", caseUpdate),
+    ("decrypt", caseDecrypt),
+    ("colour.separate", caseColourSeparate),
+    ("colour.encrypt", caseColourEncrypt),
+    ("colour.image", caseColourImage),
+    ("colour.split", caseColourSplit),
+    ("moonfield.fill", caseMoonfieldFill),
+    ("moonfield.randomFill", caseMoonfieldRandomFill),
+    ("moonfield.imageComplement", caseImageComplement),
+    ("moonfield.write.ps", caseWritePS),
+    ("moonfield.write.pdf", caseWritePDF),
+    ]
+
+
+def peakKB():
+    """Return the peak resident memory of this process so far, in KB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak // 1024 # bytes there, KB elsewhere
+    return peak
+
+def runCase(setup, side, repeat, connection):
+    """In a child process: prepare the case, run it repeat times and send
+    back the best time and the growth in peak memory during the runs."""
+
+    tmp = tempfile.mkdtemp(prefix="vck-bench")
+    try:
+        function, pixels = setup(side, tmp)
+        before = peakKB()
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        connection.send((best, pixels, peakKB() - before))
+    finally:
+        shutil.rmtree(tmp, True)
+        connection.close()
+
+def measure(setup, side, repeat):
+    """Run a case in a child process and return its results as a
+    dictionary (with "error" set if the child died)."""
+
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=runCase,
+                                      args=(setup, side, repeat, child))
+    process.start()
+    child.close()
+    result = {"side": side}
+    try:
+        best, pixels, peak = parent.recv()
+        result.update({"seconds": best, "pixels": pixels,
+                       "pixelsPerSecond": pixels / max(best, 1e-9),
+                       "peakKB": peak})
+    except EOFError:
+        result["error"] = "child died (exit code %s)" % process.exitcode
+    process.join()
+    if process.exitcode and "error" not in result:
+        result["error"] = "exit code %d" % process.exitcode
+    return result
+
+def compare(old, new, tolerance):
+    """Print how the results in new compare with those in old, and return
+    the number of regressions (throughput down by more than tolerance)."""
+
+    before = {}
+    for r in old["results"]:
+        before[(r["case"], r["side"])] = r
+    regressions = 0
+    print "%-28s %6s %12s %12s %8s" % ("case", "side", "old px/s",
+                                        "new px/s", "ratio")
+    for r in new["results"]:
+        o = before.get((r["case"], r["side"]))
+        if not o or "error" in o or "error" in r:
+            continue
+        ratio = r["pixelsPerSecond"] / o["pixelsPerSecond"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            flag = "  REGRESSION"
+            regressions = regressions + 1
+        print "%-28s %6d %12.4g %12.4g %8.2f%s" % (
+            r["case"], r["side"], o["pixelsPerSecond"],
+            r["pixelsPerSecond"], ratio, flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the primitives of the Visual Cryptography Kit.")
+    parser.add_argument("-s", "--sizes", default="64,256,1024,4096,8192",
+                        help="comma separated sides of the square pictures "
+                        "(default %(default)s)")
+    parser.add_argument("-c", "--cases", default="*",
+                        help="comma separated glob patterns of the cases to "
+                        "run (default all; --list shows them)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per case, of which the best is kept")
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="OLD.json",
+                        help="compare with the results of an earlier run "
+                        "and exit with status 1 if anything got slower")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown allowed by --compare (default 0.1)")
+    parser.add_argument("--list", action="store_true",
+                        help="list the cases and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, setup in cases:
+            print name
+        return 0
+
+    patterns = args.cases.split(",")
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = []
+    print "%-28s %6s %10s %12s %10s" % ("case", "side", "seconds", "px/s",
+                                         "peak MB")
+    for name, setup in cases:
+        if not [p for p in patterns if fnmatch.fnmatch(name, p)]:
+            continue
+        for side in sizes:
+            result = measure(setup, side, args.repeat)
+            result["case"] = name
+            results.append(result)
+            if "error" in result:
+                print "%-28s %6d %s" % (name, side, result["error"])
+            else:
+                print "%-28s %6d %10.4f %12.4g %10.1f" % (
+                    name, side, result["seconds"], result["pixelsPerSecond"],
+                    result["peakKB"] / 1024.0)
+            sys.stdout.flush()
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "python": platform.python_version(),
+                 "numpy": numpy.__version__,
+                 "platform": platform.platform(),
+                 "cpus": multiprocessing.cpu_count(),
+                 "repeat": args.repeat},
+        "results": results}
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+    if args.compare:
+        print
+        if compare(json.load(open(args.compare)), report, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
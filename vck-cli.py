@@ -0,0 +1,245 @@
+# This file is part of the vck distribution: get the rest from
+# http://www.cl.cam.ac.uk/~fms27/vck/
+#
+# A command line front end to the kit that never opens a window, so it can
+# be used on machines with no display. Run it with --help for the details.
+
+import time
+started = time.time()
+
+import sys
+import json
+import argparse
+
+import vck
+imported = time.time()
+
+
+def schemeFor(args, seedNeeded=0):
+    """Return the subpixel scheme asked for. If seedNeeded, the scheme
+    has to come out the same in another run (the pad and the cryptograph
+    being made by different commands), so naorshamir needs a --seed."""
+
+    if seedNeeded and args.scheme == "naorshamir" and args.seed is None:
+        parser.error("--scheme naorshamir needs a --seed here, the same "
+                     "one for the pad and for everything encrypted with it")
+    return vck.namedScheme(args.scheme, args.seed)
+
+def pad(args):
+    if args.grey:
+        vck.makePadG(None, (args.width, args.height),
+                     args.output or "pad.ps", args.raw or "rawpad.mfd")
+    elif args.stream:
+        vck.makePadStream((args.width, args.height), args.output or "pad.tif",
+                          args.raw or "rawpad.pbm", schemeFor(args, 1))
+    else:
+        vck.makePad((args.width, args.height), args.output or "pad.tif",
+                    args.raw or "rawpad.pbm", schemeFor(args, 1))
+
+def plaintext(args):
+    """Return the image to encrypt: its filename or, with --halftone, the
+    bitmap it halftones to."""
+
+    if args.halftone:
+        return vck.halftone(args.image, args.halftone)
+    return args.image
+
+def encrypt(args):
+    if args.grey:
+        ciphertext, _ = vck.makeCryptographG(
+            None, args.image, args.output or "coded.ps",
+            args.raw or "rawpad.mfd")
+        if args.dump:
+            ciphertext.dump(args.dump)
+    elif args.stream:
+        vck.makeCryptographStream(args.image, args.output or "coded.tif",
+                                  args.raw or "rawpad.pbm",
+                                  schemeFor(args, 1))
+    else:
+        vck.makeCryptograph(plaintext(args), args.output or "coded.tif",
+                            args.raw or "rawpad.pbm", schemeFor(args, 1))
+
+def decrypt(args):
+    if args.grey:
+        share1 = vck.moonfield_undump(args.share1)
+        share2 = vck.moonfield_undump(args.share2)
+        result = vck.OR(share1.rasterize(args.radius),
+                        share2.rasterize(args.radius))
+        result.write(args.output or "decrypted.png")
+    elif args.stream:
+        vck.decryptStream(args.share1, args.share2,
+                          args.output or "decrypted.tif")
+    else:
+        result = vck.decrypt(vck.bitmap(args.share1), vck.bitmap(args.share2))
+        result.write(args.output or "decrypted.tif")
+
+def split(args):
+    if args.colour:
+        vck.splitImageColour(args.image, args.share1 or "share1.png",
+                             args.share2 or "share2.png",
+                             schemeFor(args),
+                             args.halftone or "floydsteinberg")
+    elif args.grey:
+        vck.splitImageG(None, args.image, args.share1 or "share1.ps",
+                        args.share2 or "share2.ps")
+    elif args.stream:
+        vck.splitImageStream(args.image, args.share1 or "share1.tif",
+                             args.share2 or "share2.tif",
+                             schemeFor(args))
+    else:
+        vck.splitImage(args.image, args.share1 or "share1.tif",
+                       args.share2 or "share2.tif", schemeFor(args),
+                       args.halftone)
+
+def check(args):
+    if args.grey:
+        shares = [vck.moonfield_undump(name) for name in args.shares]
+        plaintext = args.plaintext
+    else:
+        shares = [vck.bitmap(name) for name in args.shares]
+        plaintext = vck.bitmap(args.plaintext)
+    report = vck.checkShares(shares, plaintext, args.radius)
+    json.dump(report, sys.stdout, indent=1, sort_keys=True)
+    print
+    if args.strict:
+        good = [s for s in report["shares"] if s["independent"]]
+        if len(good) < len(shares) or not report.get("separable", 1):
+            sys.exit(1)
+
+def update(args):
+    boxes = None
+    if args.box:
+        boxes = [tuple([int(n) for n in box.split(",")]) for box in args.box]
+    vck.updateCryptograph(plaintext(args), args.output, args.raw, boxes,
+                          args.previous, schemeFor(args, 1))
+
+def threshold(args):
+    vck.splitImageThreshold(args.image, args.k, args.n, args.shares)
+
+
+
+parser = argparse.ArgumentParser(
+    description="Visual cryptography without windows. Monochrome by "
+    "default, greyscale (halfmoons) with --grey.")
+parser.add_argument("--timing", action="store_true",
+                    help="report the time taken to import vck, to start up "
+                    "and to run the command, on stderr")
+commands = parser.add_subparsers(title="commands")
+
+def addCommand(name, function, help):
+    command = commands.add_parser(name, help=help, description=help)
+    command.set_defaults(function=function)
+    command.add_argument("--grey", action="store_true",
+                         help="greyscale: moonfields and postscript/PDF")
+    command.add_argument("--stream", action="store_true",
+                         help="monochrome only: work a band of rows at a "
+                         "time (PBM/TIFF files only)")
+    addScheme(command, "monochrome only: subpixel scheme")
+    return command
+
+def addScheme(command, help):
+    command.add_argument("--scheme", default="diagonal",
+                         choices=vck.schemeNames, help=help)
+    command.add_argument("--seed", help="naorshamir only: string that "
+                         "picks the patterns; pad, encrypt and update must "
+                         "all be given the same one")
+
+command = addCommand("pad", pad, "make a random pad")
+command.add_argument("width", type=int)
+command.add_argument("height", type=int)
+command.add_argument("-o", "--output",
+                     help="pad ready for use (default pad.tif or pad.ps)")
+command.add_argument("-r", "--raw", help="raw pad to keep for encrypting "
+                     "(default rawpad.pbm or rawpad.mfd)")
+
+def addHalftone(command):
+    command.add_argument("--halftone", choices=["floydsteinberg", "bayer",
+                                                "bluenoise", "threshold"],
+                         help="monochrome only: halftone a greyscale image "
+                         "by this method first, rather than letting PIL "
+                         "convert it (not with --stream)")
+
+command = addCommand("encrypt", encrypt, "encrypt an image with a raw pad")
+addHalftone(command)
+command.add_argument("image")
+command.add_argument("-o", "--output",
+                     help="cryptograph (default coded.tif or coded.ps)")
+command.add_argument("-r", "--raw", help="raw pad made by the pad command "
+                     "(default rawpad.pbm or rawpad.mfd)")
+command.add_argument("-d", "--dump", help="greyscale only: also dump the "
+                     "raw cryptograph moonfield here, for decrypt")
+
+command = addCommand("decrypt", decrypt, "simulate superimposing two "
+                     "shares (for --grey, two dumped moonfields)")
+command.add_argument("share1")
+command.add_argument("share2")
+command.add_argument("-o", "--output",
+                     help="result (default decrypted.tif or decrypted.png)")
+command.add_argument("--radius", type=int, default=vck.moonfieldViewer.R,
+                     help="greyscale only: halfmoon radius in pixels")
+
+command = addCommand("split", split, "split an image into two shares")
+addHalftone(command)
+command.add_argument("--colour", action="store_true",
+                     help="split a colour image into two colour shares "
+                     "(PNG by default), each of its cyan, magenta and yellow "
+                     "channels halftoned (by --halftone, default "
+                     "floydsteinberg) and encrypted on its own")
+command.add_argument("image")
+command.add_argument("share1", nargs="?")
+command.add_argument("share2", nargs="?")
+
+command = addCommand("check", check, "superimpose shares and report how "
+                     "well they reproduce the plaintext and whether each "
+                     "share on its own gives anything away")
+command.add_argument("plaintext")
+command.add_argument("shares", nargs="+", help="the shares (for --grey, "
+                     "dumped moonfields)")
+command.add_argument("--radius", type=int, default=vck.moonfieldViewer.R,
+                     help="greyscale only: halfmoon radius in pixels")
+command.add_argument("--strict", action="store_true",
+                     help="exit with status 1 if a share gives anything "
+                     "away or (monochrome) some pixels can't be read")
+
+command = commands.add_parser(
+    "update", help="re-encrypt only what changed in an image",
+    description="Bring a raw PBM cryptograph made by encrypt up to date "
+    "with a changed image, in place, by re-encrypting only the rectangles "
+    "that changed (given with --box, or found by comparing with the image "
+    "given with --previous; with neither, the whole image is done).")
+command.set_defaults(function=update)
+addHalftone(command)
+command.add_argument("image")
+command.add_argument("-o", "--output", default="coded.pbm",
+                     help="cryptograph to update (default %(default)s)")
+command.add_argument("-r", "--raw", default="rawpad.pbm",
+                     help="raw pad it was made with (default %(default)s)")
+addScheme(command, "subpixel scheme it was made with")
+command.add_argument("-p", "--previous",
+                     help="the image the cryptograph was made from")
+command.add_argument("-b", "--box", action="append",
+                     metavar="LEFT,TOP,RIGHT,BOTTOM",
+                     help="a rectangle that changed (may be repeated)")
+
+command = commands.add_parser(
+    "threshold", help="split an image into n shares, any k of which "
+    "reveal it", description="Split a monochrome image into n shares, any "
+    "k of which reveal it when superimposed while fewer reveal nothing.")
+command.set_defaults(function=threshold)
+command.add_argument("image")
+command.add_argument("-k", type=int, default=3,
+                     help="shares needed to see the image (default 3)")
+command.add_argument("-n", type=int, default=5,
+                     help="shares made (default 5)")
+command.add_argument("--shares", default="share%d.tif",
+                     help="filename pattern of the shares, %%d being their "
+                     "number (default %(default)s)")
+
+args = parser.parse_args()
+ready = time.time()
+args.function(args)
+finished = time.time()
+
+if args.timing:
+    sys.stderr.write("import vck: %.3fs\nstartup: %.3fs\ncommand: %.3fs\n" %
+                     (imported - started, ready - started, finished - ready))
@@ -0,0 +1,559 @@
+# This file is part of the vck distribution: get the rest from
+# http://www.cl.cam.ac.uk/~fms27/vck/
+#
+# A small HTTP service that splits, encrypts and decrypts pictures, so that
+# programs needing many of them don't have to start a Python (and load PIL)
+# for each one. Requests are read by threads, the work is done by a pool of
+# worker processes, and a request that arrives when too much work is
+# already waiting is turned away at once with a 503 rather than queued
+# indefinitely. It listens on a TCP port or on a Unix socket. The same
+# script is also a client for it. Run it with --help for the details:
+#
+#   python vck-serve.py serve --workers 4
+#   python vck-serve.py client split mypicture.tif -o shares
+#   python vck-serve.py client metrics
+#
+# The requests are all POSTs whose body is the picture (or, for /decrypt,
+# a tar file of the two shares); the answer is the picture made or, when
+# there are several, a tar file of them, streamed out as it is read:
+#
+#   POST /split?scheme=diagonal&format=tif   monochrome picture -> 2 shares
+#   POST /split-grey?format=pdf              greyscale picture -> 2 shares
+#   POST /encrypt?pad=NAME&x=0&y=0           monochrome picture -> cryptograph
+#                                            made with the raw pad NAME from
+#                                            the server's pad directory
+#                                            (scheme=naorshamir also needs
+#                                            the seed=... the pad was made
+#                                            with)
+#   POST /decrypt?format=png                 tar of 2 shares -> their overlay
+#   GET /metrics                             statistics, for Prometheus
+
+import vck
+import sys
+import os
+import time
+import shutil
+import tempfile
+import tarfile
+import argparse
+import threading
+import socket
+import urllib
+import urlparse
+import httplib
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import numpy
+from PIL import Image
+
+
+formats = {".tif": "image/tiff", ".pbm": "image/x-portable-bitmap",
+           ".png": "image/png", ".gif": "image/gif",
+           ".ps": "application/postscript", ".pdf": "application/pdf"}
+
+# The jobs, run by the worker processes. Each one works in a directory of
+# its own, which holds the upload, and returns the names of the files it
+# made there.
+
+def splitJob(directory, scheme, seed, ext):
+    plaintext = vck.bitmap(os.path.join(directory, "upload"))
+    ciphertext, pad = vck.encryptFused(plaintext, None,
+                                       vck.namedScheme(scheme, seed))
+    names = ["share1" + ext, "share2" + ext]
+    pad.write(os.path.join(directory, names[0]))
+    ciphertext.write(os.path.join(directory, names[1]))
+    return names
+
+def splitGreyJob(directory, ext):
+    image = Image.open(os.path.join(directory, "upload")).convert("L")
+    names = ["share1" + ext, "share2" + ext]
+    dumpFile = os.path.join(directory, "rawpad.mfd")
+    vck.makePadG(None, image.size, os.path.join(directory, names[0]),
+                 dumpFile)
+    vck.makeCryptographG(None, image, os.path.join(directory, names[1]),
+                         dumpFile, 0)
+    return names
+
+def encryptJob(directory, padFile, scheme, seed, ext, origin):
+    upload = os.path.join(directory, "upload")
+    # PIL reads only the headers here, so this costs next to nothing.
+    width, height = Image.open(upload).size
+    padWidth, padHeight = Image.open(padFile).size
+    x, y = origin or (0, 0)
+    if x + width > padWidth or y + height > padHeight:
+        raise ValueError, "the picture is %dx%d but pad %s is %dx%d, which " \
+              "doesn't leave room for it at (%d, %d)" % (
+            width, height, os.path.basename(padFile), padWidth, padHeight,
+            x, y)
+    # The pad comes from each worker's vck.pads cache after the first time;
+    # namedScheme() hands back the same scheme for the same seed, so its
+    # pixelcoded pad is found there too.
+    names = ["ciphertext" + ext]
+    vck.makeCryptograph(upload,
+                        os.path.join(directory, names[0]), padFile,
+                        vck.namedScheme(scheme, seed), origin)
+    return names
+
+def decryptJob(directory, ext):
+    archive = tarfile.open(os.path.join(directory, "upload"))
+    shares = []
+    for member in archive.getmembers():
+        if member.isfile() and len(shares) < 2:
+            name = os.path.join(directory, "share%d" % len(shares))
+            f = open(name, "wb")
+            shutil.copyfileobj(archive.extractfile(member), f)
+            f.close()
+            shares.append(vck.bitmap(name))
+    archive.close()
+    if len(shares) != 2:
+        raise ValueError, "need a tar file of exactly two shares"
+    names = ["decrypted" + ext]
+    vck.decrypt(shares[0], shares[1]).write(os.path.join(directory, names[0]))
+    return names
+
+jobs = {"/split": splitJob, "/split-grey": splitGreyJob,
+        "/encrypt": encryptJob, "/decrypt": decryptJob}
+
+def runJob(job):
+    """Run a job in a worker process. Errors are returned rather than
+    raised, as ("error", message), since a 2.x Pool only calls back on
+    success and the parent needs to hear about every job finishing."""
+
+    endpoint, args = job
+    try:
+        return ("ok", jobs[endpoint](*args))
+    except Exception, e:
+        return ("error", "%s: %s" % (e.__class__.__name__, e))
+
+
+class Busy(Exception):
+    pass
+
+class service:
+    """The state shared by the threads serving requests: the pool of
+    workers, the limit on the work waiting for them and the statistics."""
+
+    def __init__(self, workers, queue, timeout, maxUpload, padDirectory):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.capacity = queue or 2 * self.workers
+        self.timeout = timeout
+        self.maxUpload = maxUpload
+        self.padDirectory = padDirectory
+        self.pool = multiprocessing.Pool(self.workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.requests = collections.defaultdict(int)
+        self.latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=1000))
+        self.totals = collections.defaultdict(float)
+
+    def submit(self, endpoint, args):
+        """Hand a job to the pool and return its AsyncResult, or raise Busy
+        if as many jobs as the capacity are already queued or running. A
+        job that times out still counts until its worker is done with
+        it."""
+
+        self.lock.acquire()
+        try:
+            if self.pending >= self.capacity:
+                raise Busy
+            self.pending = self.pending + 1
+        finally:
+            self.lock.release()
+        return self.pool.apply_async(runJob, ((endpoint, args),),
+                                     callback=self.finished)
+
+    def finished(self, result):
+        self.lock.acquire()
+        self.pending = self.pending - 1
+        self.lock.release()
+
+    def record(self, endpoint, status, seconds):
+        if endpoint not in jobs and endpoint != "/metrics":
+            endpoint = "other"
+        self.lock.acquire()
+        try:
+            self.requests[(endpoint, status)] += 1
+            self.latencies[endpoint].append(seconds)
+            self.totals[endpoint] += seconds
+        finally:
+            self.lock.release()
+
+    def metrics(self):
+        """Return the statistics in the Prometheus text exposition format:
+        the jobs waiting or running, the requests served by endpoint and
+        status, and the 50th, 90th and 99th percentiles of the latency of
+        the last 1000 requests to each endpoint."""
+
+        self.lock.acquire()
+        try:
+            lines = [
+                "# HELP vck_serve_jobs Jobs queued or running.",
+                "# TYPE vck_serve_jobs gauge",
+                "vck_serve_jobs %d" % self.pending,
+                "# HELP vck_serve_capacity Jobs allowed before turning "
+                "requests away.",
+                "# TYPE vck_serve_capacity gauge",
+                "vck_serve_capacity %d" % self.capacity,
+                "# HELP vck_serve_workers Worker processes.",
+                "# TYPE vck_serve_workers gauge",
+                "vck_serve_workers %d" % self.workers,
+                "# HELP vck_serve_requests_total Requests served.",
+                "# TYPE vck_serve_requests_total counter"]
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append('vck_serve_requests_total{endpoint="%s",'
+                             'status="%d"} %d' % (endpoint, status, count))
+            lines.append("# HELP vck_serve_latency_seconds Time taken to "
+                         "serve requests.")
+            lines.append("# TYPE vck_serve_latency_seconds summary")
+            for endpoint, latencies in sorted(self.latencies.items()):
+                for q in (50, 90, 99):
+                    lines.append('vck_serve_latency_seconds{endpoint="%s",'
+                                 'quantile="%g"} %.6f' % (
+                        endpoint, q / 100.0, numpy.percentile(latencies, q)))
+                count = sum([n for (e, s), n in self.requests.items()
+                             if e == endpoint])
+                lines.append('vck_serve_latency_seconds_sum{endpoint="%s"} '
+                             '%.6f' % (endpoint, self.totals[endpoint]))
+                lines.append('vck_serve_latency_seconds_count{endpoint="%s"} '
+                             '%d' % (endpoint, count))
+            return "\n".join(lines) + "\n"
+        finally:
+            self.lock.release()
+
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "vck-serve/1.0"
+    quiet = 0
+
+    def address_string(self):
+        if type(self.client_address) != type(()):
+            return "unix"
+        return self.client_address[0]
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def answer(self, status, text, headers={}):
+        """Send a short plain text answer."""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(text)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(text)
+        return status
+
+    def do_GET(self):
+        start = time.time()
+        path = urlparse.urlparse(self.path).path
+        if path == "/metrics":
+            text = self.server.service.metrics()
+            status = self.answer(200, text, {
+                "Content-Type": "text/plain; version=0.0.4"})
+        else:
+            status = self.answer(404, "no such page\n")
+        self.server.service.record(path, status, time.time() - start)
+
+    def do_POST(self):
+        start = time.time()
+        path = urlparse.urlparse(self.path).path
+        directory = tempfile.mkdtemp(prefix="vck-serve")
+        try:
+            status = self.post(path, directory)
+        finally:
+            shutil.rmtree(directory, True)
+        self.server.service.record(path, status, time.time() - start)
+
+    def post(self, path, directory):
+        """Serve a POST, using directory for the files, and return the
+        status of the answer."""
+
+        service = self.server.service
+        if path not in jobs:
+            return self.answer(404, "no such job\n")
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        try:
+            args = self.arguments(path, query, directory)
+        except ValueError, e:
+            return self.answer(400, str(e) + "\n")
+
+        length = self.headers.getheader("Content-Length")
+        if length is None:
+            return self.answer(411, "Content-Length needed\n")
+        length = int(length)
+        if length > service.maxUpload:
+            return self.answer(413, "upload bigger than %d bytes\n" %
+                               service.maxUpload)
+        upload = open(os.path.join(directory, "upload"), "wb")
+        while length:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
+                break
+            upload.write(chunk)
+            length = length - len(chunk)
+        upload.close()
+        if length:
+            return self.answer(400, "upload cut short\n")
+
+        try:
+            result = service.submit(path, args)
+        except Busy:
+            return self.answer(503, "too busy, try again later\n",
+                               {"Retry-After": "1"})
+        try:
+            outcome, value = result.get(service.timeout)
+        except multiprocessing.TimeoutError:
+            return self.answer(504, "timed out after %gs\n" % service.timeout)
+        if outcome == "error":
+            return self.answer(400, value + "\n")
+        self.stream(directory, value)
+        return 200
+
+    def arguments(self, path, query, directory):
+        """Check the query and return the arguments for the job, raising
+        ValueError if anything is wrong."""
+
+        ext = "." + query.get("format", path == "/split-grey" and "pdf"
+                              or "tif").lower()
+        if ext not in formats or (path == "/split-grey") != (
+            ext in (".ps", ".pdf")):
+            raise ValueError, "unsuitable format " + ext[1:]
+        scheme = query.get("scheme", "diagonal")
+        if scheme not in vck.schemeNames:
+            raise ValueError, "unknown scheme " + scheme
+        seed = query.get("seed")
+        if path == "/split":
+            return (directory, scheme, seed, ext)
+        if path == "/split-grey":
+            return (directory, ext)
+        if path == "/decrypt":
+            return (directory, ext)
+        pad = query.get("pad", "")
+        if not self.server.service.padDirectory:
+            raise ValueError, "this server has no pads"
+        if not pad or pad != os.path.basename(pad) or pad.startswith("."):
+            raise ValueError, "bad pad name " + repr(pad)
+        padFile = os.path.join(self.server.service.padDirectory, pad)
+        if not os.path.isfile(padFile):
+            raise ValueError, "no pad " + pad
+        if scheme == "naorshamir" and seed is None:
+            # With a random seed the patterns couldn't match the pad's.
+            raise ValueError, "scheme naorshamir needs the seed of the pad"
+        origin = None
+        if "x" in query or "y" in query:
+            try:
+                origin = (int(query.get("x", 0)), int(query.get("y", 0)))
+            except ValueError:
+                raise ValueError, "x and y must be integers"
+            if min(origin) < 0:
+                raise ValueError, "x and y can't be negative"
+        return (directory, padFile, scheme, seed, ext, origin)
+
+    def stream(self, directory, names):
+        """Send the files with the given names back: as they are if there
+        is just one, as a tar file otherwise."""
+
+        self.send_response(200)
+        if len(names) == 1:
+            name = os.path.join(directory, names[0])
+            self.send_header("Content-Type",
+                             formats[os.path.splitext(name)[1]])
+            self.send_header("Content-Length", str(os.path.getsize(name)))
+            self.send_header("Content-Disposition",
+                             "attachment; filename=%s" % names[0])
+            self.end_headers()
+            f = open(name, "rb")
+            shutil.copyfileobj(f, self.wfile, 65536)
+            f.close()
+        else:
+            # No length: the connection is closed at the end instead.
+            self.send_header("Content-Type", "application/x-tar")
+            self.end_headers()
+            archive = tarfile.open(mode="w|", fileobj=self.wfile)
+            for name in names:
+                archive.add(os.path.join(directory, name), name)
+            archive.close()
+
+
+class tcpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class unixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    handler.quiet = args.quiet
+    # Nor may a client take longer than that to send or take a request.
+    handler.timeout = args.timeout
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = unixServer(args.unix, handler)
+        where = args.unix
+    else:
+        host, port = args.listen.rsplit(":", 1)
+        server = tcpServer((host, int(port)), handler)
+        where = "http://%s:%s/" % (host, port)
+    # The pool is made after binding, so a busy port fails straight away,
+    # but before any thread is started, since it forks.
+    server.service = service(args.workers, args.queue, args.timeout,
+                             args.max_upload, args.pads)
+    sys.stderr.write("vck-serve: %d workers, listening on %s\n" %
+                     (server.service.workers, where))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.service.pool.terminate()
+    if args.unix:
+        os.remove(args.unix)
+
+
+# The client.
+
+class unixConnection(httplib.HTTPConnection):
+    """An HTTPConnection over a Unix socket."""
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def connect(server, timeout):
+    if server.startswith("unix:"):
+        return unixConnection(server[len("unix:"):], timeout)
+    return httplib.HTTPConnection(urlparse.urlparse(server).netloc,
+                                  timeout=timeout)
+
+def client(args):
+    connection = connect(args.server, args.timeout)
+    if args.command == "metrics":
+        connection.request("GET", "/metrics")
+    else:
+        if args.command == "decrypt":
+            if len(args.files) != 2:
+                sys.exit("decrypt needs two shares")
+            body = cStringIO.StringIO()
+            archive = tarfile.open(mode="w", fileobj=body)
+            for name in args.files:
+                archive.add(name, os.path.basename(name))
+            archive.close()
+            body = body.getvalue()
+        else:
+            if len(args.files) != 1:
+                sys.exit(args.command + " needs one picture")
+            body = open(args.files[0], "rb")
+        query = {}
+        for name in ("format", "scheme", "seed", "pad", "x", "y"):
+            if getattr(args, name) is not None:
+                query[name] = getattr(args, name)
+        path = "/" + args.command
+        if query:
+            path = path + "?" + urllib.urlencode(query)
+        connection.request("POST", path, body)
+    response = connection.getresponse()
+    if response.status != 200:
+        sys.stderr.write("%d %s: %s" % (response.status, response.reason,
+                                        response.read()))
+        return 1
+    if args.command == "metrics":
+        sys.stdout.write(response.read())
+        return 0
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    if response.getheader("Content-Type") == "application/x-tar":
+        archive = tarfile.open(mode="r|", fileobj=response)
+        for member in archive:
+            # Only plain files, and only into the output directory.
+            name = os.path.basename(member.name)
+            if member.isfile() and name:
+                f = open(os.path.join(args.output, name), "wb")
+                shutil.copyfileobj(archive.extractfile(member), f)
+                f.close()
+                print os.path.join(args.output, name)
+    else:
+        disposition = response.getheader("Content-Disposition", "")
+        name = os.path.basename(disposition.split("filename=")[-1]) \
+               or "result"
+        f = open(os.path.join(args.output, name), "wb")
+        shutil.copyfileobj(response, f)
+        f.close()
+        print os.path.join(args.output, name)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the Visual Cryptography Kit over HTTP, or talk "
+        "to such a server.")
+    commands = parser.add_subparsers(title="commands")
+
+    command = commands.add_parser("serve", help="run the server")
+    command.set_defaults(function=serve)
+    command.add_argument("--listen", default="127.0.0.1:8027",
+                         help="TCP address to listen on (default "
+                         "%(default)s)")
+    command.add_argument("--unix", metavar="PATH",
+                         help="listen on this Unix socket instead")
+    command.add_argument("-j", "--workers", type=int, default=None,
+                         help="worker processes (default: one per CPU)")
+    command.add_argument("--queue", type=int, default=None,
+                         help="jobs queued or running before further "
+                         "requests get a 503 (default: twice the workers)")
+    command.add_argument("--timeout", type=float, default=60,
+                         help="seconds a request may wait for its job "
+                         "before getting a 504 (default %(default)s)")
+    command.add_argument("--max-upload", type=int, default=64*1024*1024,
+                         help="largest upload accepted, in bytes (default "
+                         "%(default)s)")
+    command.add_argument("--pads", metavar="DIRECTORY",
+                         help="directory of the raw pads /encrypt may use")
+    command.add_argument("-q", "--quiet", action="store_true",
+                         help="don't log every request")
+
+    command = commands.add_parser("client", help="send a request to a "
+                                  "server and save what comes back")
+    command.set_defaults(function=client)
+    command.add_argument("command", choices=["split", "split-grey",
+                                             "encrypt", "decrypt", "metrics"])
+    command.add_argument("files", nargs="*",
+                         help="the picture, or for decrypt the two shares")
+    command.add_argument("--server", default="http://127.0.0.1:8027",
+                         help="http://HOST:PORT or unix:PATH (default "
+                         "%(default)s)")
+    command.add_argument("-o", "--output", default=".",
+                         help="directory for the results (default: here)")
+    command.add_argument("--format", help="extension of the results, e.g. "
+                         "pbm or pdf")
+    command.add_argument("--scheme", choices=vck.schemeNames)
+    command.add_argument("--seed", help="naorshamir only: string that "
+                         "picks the patterns (for encrypt, the one the pad "
+                         "was made with)")
+    command.add_argument("--pad", help="encrypt only: name of the raw pad "
+                         "on the server")
+    command.add_argument("-x", type=int, help="encrypt only: pad origin x")
+    command.add_argument("-y", type=int, help="encrypt only: pad origin y")
+    command.add_argument("--timeout", type=float, default=None,
+                         help="seconds to wait for the server")
+
+    args = parser.parse_args()
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
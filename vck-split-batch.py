@@ -0,0 +1,36 @@
+# This file is part of the vck distribution: get the rest from
+# http://www.cl.cam.ac.uk/~fms27/vck/
+
+import vck
+import sys
+import optparse
+
+parser = optparse.OptionParser(
+    usage="python %prog [options] outputdir source...",
+    description="Split every monochrome image given by the sources (image "
+    "files, directories, glob patterns or .txt/.lst manifests listing one "
+    "image per line) into two shares written to outputdir, along with a "
+    "manifest.json describing the results. No windows are opened.")
+parser.add_option("-j", "--workers", type="int", default=None,
+                  help="number of worker processes (default: one per CPU)")
+parser.add_option("-e", "--ext", default=None,
+                  help="extension (and so format) of the shares, e.g. .pbm "
+                  "(default: the same as the image)")
+parser.add_option("-s", "--scheme", default="diagonal",
+                  choices=vck.schemeNames,
+                  help="subpixel scheme: diagonal (default), horizontal, "
+                  "vertical or naorshamir")
+options, args = parser.parse_args()
+if len(args) < 2:
+    parser.error("need an output directory and at least one source")
+
+scheme = vck.namedScheme(options.scheme)
+
+records = vck.splitImages(args[1:], args[0], scheme, options.workers,
+                          options.ext)
+failures = [r for r in records if "error" in r]
+for r in failures:
+    print "%s: %s" % (r["image"], r["error"])
+print "%d images split, %d failed." % (len(records) - len(failures),
+                                       len(failures))
+sys.exit(failures and 1 or 0)
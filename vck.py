@@ -45,17 +45,187 @@ efficiency, with the aim of simply making the algorithms obvious. It is not
 expected that this kit will be used for actual encryption and so
 facilitating exploration and exporting an obvious API was deemed to be more
 important than making the program fast.
+
+That said, bitmaps keep their pixels in a packed buffer (one bit per pixel,
+see the bitmap class) rather than in a PIL image, and PIL is only used to
+load, save and display them, so that the kit stays usable on print-sized
+pictures.
 """
 
-import Tkinter
 from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageTk
+import numpy
 #import whrandom
-import random
+import os
+import hashlib
+import struct
+import zlib
+import multiprocessing
+import multiprocessing.pool
 import string
 import pickle
 import sys
+import time
+import glob
+import tempfile
+import json
+import contextlib
+import functools
+import itertools
+import collections
+import threading
+
+# Tkinter and ImageTk are only needed to display things, so they are only
+# imported, by _importGUI(), when the first window is made. This way the
+# kit starts up faster and works on machines with no display at all.
+Tkinter = None
+ImageTk = None
+
+def _importGUI():
+    """Import Tkinter and ImageTk into the module, if not done already."""
+
+    global Tkinter, ImageTk
+    if Tkinter is None:
+        import Tkinter as tk
+        from PIL import ImageTk as itk
+        Tkinter, ImageTk = tk, itk
+
+# --------------------------------------------------------------
+# Instrumentation
+
+# The callStats objects currently collecting statistics (see instrument()).
+# When there are none, as is normally the case, the instrumented functions
+# cost just one extra test per call.
+_collectors = []
+
+# Running totals of the bitmaps made and of the bytes allocated for the
+# pixels of bitmaps and moonfields, while anybody is collecting.
+_allocated = {"bitmaps": 0, "bytes": 0}
+
+def _noteAllocation(array, isBitmap):
+    """Record the allocation of array for the pixels of a new bitmap (if
+    isBitmap is true) or moonfield. Memory-mapped files don't count."""
+
+    if not isinstance(array, numpy.memmap):
+        _allocated["bytes"] = _allocated["bytes"] + array.nbytes
+    if isBitmap:
+        _allocated["bitmaps"] = _allocated["bitmaps"] + 1
+
+def _pixels(picture):
+    """Return the number of pixels (or cells) in picture, which may be
+    anything with a size() method or a (width, height) pair."""
+
+    if hasattr(picture, "size"):
+        picture = picture.size()
+    width, height = picture
+    return width * height
+
+def _instrumented(name, pixels):
+    """Return a decorator that makes a function report its calls, under
+    the given name, to whoever is collecting statistics. pixels is a
+    function that takes the arguments and the result of a call and returns
+    the number of pixels that call processed."""
+
+    def decorator(function, name=name, pixels=pixels):
+        def instrumentedFunction(*args, **kwargs):
+            if not _collectors:
+                return function(*args, **kwargs)
+            bitmaps, bytes = _allocated["bitmaps"], _allocated["bytes"]
+            start = time.time()
+            result = function(*args, **kwargs)
+            record = {
+                "seconds": time.time() - start,
+                "pixels": pixels(args, result),
+                "bytes": _allocated["bytes"] - bytes,
+                "bitmaps": _allocated["bitmaps"] - bitmaps,
+                }
+            for collector in _collectors[:]:
+                collector.record(name, record)
+            return result
+        return functools.wraps(function)(instrumentedFunction)
+    return decorator
+
+class callStats:
+    """The statistics gathered while instrument() is in effect: for each
+    instrumented operation, the number of calls and the total wall time
+    (in seconds), pixels processed, bytes allocated for the pixels of new
+    bitmaps and moonfields and number of bitmaps made. The figures for an
+    operation include those of any others it calls: encrypt() includes
+    its XOR and pixelcodes, which are also counted on their own."""
+
+    _fields = ("calls", "seconds", "pixels", "bytes", "bitmaps")
+
+    def __init__(self, callback=None):
+        """Take an optional callback, a function that will be called as
+        callback(name, record) after every call of an instrumented
+        operation, record being a dictionary with the seconds, pixels,
+        bytes and bitmaps of that call alone."""
+
+        self.__totals = {}
+        self.__callback = callback
+
+    def record(self, name, record):
+        """Add the record of a call (see __init__()) of the named
+        operation."""
+
+        if name not in self.__totals:
+            self.__totals[name] = dict.fromkeys(self._fields, 0)
+        totals = self.__totals[name]
+        totals["calls"] = totals["calls"] + 1
+        for field in self._fields[1:]:
+            totals[field] = totals[field] + record[field]
+        if self.__callback:
+            self.__callback(name, record)
+
+    def stats(self):
+        """Return the totals so far as a dictionary mapping the name of each
+        operation to a dictionary of its calls, seconds, pixels, bytes and
+        bitmaps."""
+
+        result = {}
+        for name, totals in self.__totals.items():
+            result[name] = totals.copy()
+        return result
+
+    def prometheus(self, prefix="vck"):
+        """Return the totals so far in the Prometheus text exposition
+        format, as counters labelled by operation."""
+
+        descriptions = {
+            "calls": ("calls_total", "Calls of the operation."),
+            "seconds": ("seconds_total", "Wall time spent in the operation."),
+            "pixels": ("pixels_total", "Pixels processed by the operation."),
+            "bytes": ("allocated_bytes_total",
+                      "Bytes allocated for new bitmaps and moonfields."),
+            "bitmaps": ("bitmaps_total", "Bitmaps made by the operation."),
+            }
+        lines = []
+        names = sorted(self.__totals.keys())
+        for field in self._fields:
+            metric, text = descriptions[field]
+            metric = prefix + "_" + metric
+            lines.append("# HELP %s %s" % (metric, text))
+            lines.append("# TYPE %s counter" % metric)
+            for name in names:
+                lines.append('%s{operation="%s"} %r' %
+                             (metric, name, self.__totals[name][field]))
+        return string.join(lines, "\n") + "\n"
+
+@contextlib.contextmanager
+def instrument(callback=None):
+    """Collect statistics on the kit's hot paths for the duration of a with
+    statement: "with vck.instrument() as stats: ...", after which
+    stats.stats() or stats.prometheus() tell where the time went. The
+    optional callback is called after every call (see callStats). Several
+    collections may be in effect at once, e.g. in different threads, and
+    each one sees every call."""
+
+    collector = callStats(callback)
+    _collectors.append(collector)
+    try:
+        yield collector
+    finally:
+        _collectors.remove(collector)
+
 
 class bitmap:
     """A two-dimensional one-bit-deep bitmap suitable for VCK operations.
@@ -63,66 +233,96 @@ class bitmap:
     representation of the pixels, accessed via get() and set(), has white
     paper as 0 and black ink as 1."""
 
-    # Protected static constants for the internal representation of the
-    # pixel colours. The internal representation for pixels is that of
-    # PIL's "1" format, where 0x00 is black and 0xff is white. No other
-    # pixel values are allowed. Yeah, this gives a conversion for every
-    # pixel access: so sue me! I just found it too confusing to have paper
-    # as 1 and ink as 0, especially when it came to doing the boolean ops
-    # on the images.
-    _pixelBlack = 0x00
-    _pixelWhite = 0xff
+    # The internal representation is a packed bit buffer: a NumPy array of
+    # unsigned bytes with one row of the picture per row of the array,
+    # eight pixels per byte, most significant bit first, and each row
+    # padded up to a whole number of bytes. Unlike PIL's "1" format, a set
+    # bit is black ink and a clear bit is white paper, so that the
+    # external and internal representations finally agree and the boolean
+    # ops are just the corresponding bitwise ops on the buffer. The padding
+    # bits at the end of each row are always kept clear. PIL only gets
+    # involved when loading, saving and viewing.
 
     # Private members:
-    # __image = the image
-    # __draw = the PIL gadget you use to write on the image
+    # __width, __height = the size in pixels
+    # __bits = the packed buffer described above
 
     def __init__(self, arg1, arg2=None):
         """The allowed forms for the constructor are:
         1- vck.bitmap("image.tif")
             ...i.e. from a file name;
         2-  vck.bitmap((x,y))
-            ...ie from a 2-tuple with the size; picture will be all white."""
+            ...ie from a 2-tuple with the size; picture will be all white;
+        3-  vck.bitmap((x,y), data)
+            ...ie from a 2-tuple with the size and the packed pixels, either
+            as a string or as a NumPy array of unsigned bytes (the array is
+            adopted as it is, without copying it)."""
 
-        self.__image = None
-        self.__draw = None
+        self.__bits = None
         if type(arg1) == type(""):
             # form 1
-            raw = Image.open(arg1)
-            self.__image = raw.convert("1")
+            (self.__width, self.__height), self.__bits = _decode(arg1)
         elif type(arg1) == type((1,2)):
-            if arg2 == None:
+            self.__width, self.__height = arg1
+            shape = (self.__height, _rowBytes(self.__width))
+            if arg2 is None:
                 # form 2
-                self.__image = Image.new("1", arg1, bitmap._pixelWhite)
-
-        if not self.__image:
+                self.__bits = numpy.zeros(shape, numpy.uint8)
+            elif type(arg2) == type(""):
+                # form 3, from a string
+                self.__bits = numpy.fromstring(
+                    arg2, numpy.uint8).reshape(shape)
+            elif isinstance(arg2, numpy.ndarray):
+                # form 3, from an array
+                assert arg2.shape == shape and arg2.dtype == numpy.uint8
+                self.__bits = arg2
+
+        if self.__bits is None:
             raise TypeError, "Give me EITHER a filename OR a " \
                   "(width, height) pair and an optional string of binary data."
-
-        self.__draw = ImageDraw.ImageDraw(self.__image)
+        if _collectors:
+            _noteAllocation(self.__bits, 1)
 
 
     def set(self, x, y, colour=1):
         """Set the pixel at x, y to be of colour colour (default 1 = black
         ink). Any colour value other than 0 (white paper) is taken to be 1
-        (black ink)."""
+        (black ink). Like drawing on a PIL image, setting a pixel outside
+        the bitmap does nothing."""
 
-        inkCol = None
+        x, y = int(x), int(y)
+        if not (0 <= x < self.__width and 0 <= y < self.__height):
+            return
+        mask = 0x80 >> (x & 7)
         if colour == 0:
-            # self.__draw.setink(bitmap._pixelWhite)
-            inkCol = bitmap._pixelWhite
+            self.__bits[y, x >> 3] &= ~mask & 0xff
         else:
-            # self.__draw.setink(bitmap._pixelBlack)
-            inkCol = bitmap._pixelBlack
-        self.__draw.point((x, y), fill=inkCol)
+            self.__bits[y, x >> 3] |= mask
 
     def get(self, x, y):
         """Return the value of the pixel at x, y"""
-        return not self.__image.getpixel((x, y))
+
+        x, y = int(x), int(y)
+        if not (0 <= x < self.__width and 0 <= y < self.__height):
+            raise IndexError, "image index out of range"
+        return bool(self.__bits[y, x >> 3] & (0x80 >> (x & 7)))
 
     def size(self):
         """Return a 2-tuple (width, height) in pixels."""
-        return self.__image.size
+        return self.__width, self.__height
+
+    def buffer(self):
+        """Return the packed pixel buffer itself (not a copy): a NumPy
+        array of unsigned bytes, one row per pixel row, eight pixels per
+        byte with the leftmost in the most significant bit, 1 for black
+        ink, rows padded with clear bits to a whole number of bytes."""
+
+        return self.__bits
+
+    def image(self):
+        """Return a new PIL image of type "1" with the same pixels."""
+
+        return _imageFromBits(self.size(), self.__bits)
 
     def view(self, root, title="No name"):
         """Display this image in a toplevel window (optionally with the
@@ -131,39 +331,293 @@ class bitmap:
         which the caller must hold on to otherwise it will disappear from
         the screen for various PIL/Tkinter/refcount quirks."""
 
-        return _bitmapViewer(root, self.__image, title)
+        return _bitmapViewer(root, self.image(), title)
 
+    @_instrumented("encode", lambda args, result: _pixels(args[0]))
     def write(self, filename):
         """Write this bitmap to a file with the given filename. File type
         is deduced from the extension (exception if it can't be figured
         out)."""
 
-        self.__image.save(filename)
-
-    def pixelcode(self):
+        self.image().save(filename)
+
+    def crop(self, box):
+        """Return a new bitmap with the rectangle of this one given by box,
+        a 4-tuple (left, top, right, bottom) where right and bottom are
+        just outside the rectangle, as in PIL. If left is a multiple of 8
+        and right is either that or the right edge, the new bitmap shares
+        the pixels of this one instead of copying them."""
+
+        left, top, right, bottom = box
+        assert 0 <= left <= right <= self.__width
+        assert 0 <= top <= bottom <= self.__height
+        width = right - left
+        rows = self.__bits[top:bottom]
+        first, shift = left >> 3, left & 7
+        if shift == 0 and (right & 7 == 0 or right == self.__width):
+            return bitmap((width, bottom - top),
+                          rows[:, first:first + _rowBytes(width)])
+
+        # Shift the bits left into place, a column of bytes at a time,
+        # borrowing the top bits of each byte from the next one along.
+        wanted = _rowBytes(width)
+        wide = numpy.zeros((bottom - top, wanted + 1), numpy.uint16)
+        available = rows[:, first:first + wanted + 1]
+        wide[:, :available.shape[1]] = available
+        result = ((wide[:, :-1] << shift) | (wide[:, 1:] >> (8 - shift)))
+        result = (result & 0xff).astype(numpy.uint8)
+        _clearPadding(result, width)
+        return bitmap((width, bottom - top), result)
+
+    @_instrumented("pixelcode", lambda args, result: _pixels(args[0]))
+    def pixelcode(self, scheme=None):
         """Return a new bitmap, twice as big linearly, by pixelcoding every
         pixel of bmp into a grid of 4 pixels. Pixelcoding means translating
         each pixel into a grid of pixels in a clever way which is the core
-        idea of visual cryptography. Read the poster for more on that."""
-
-        maxX, maxY = self.size()
-        result = bitmap((2*maxX, 2*maxY))
-        for x in range(maxX):
-            for y in range(maxY):
-                pixel = self.get(x,y)
-                result.set(2*x,2*y, pixel)
-                result.set(2*x,2*y+1, not pixel)
-                result.set(2*x+1,2*y, not pixel)
-                result.set(2*x+1,2*y+1, pixel)
-        return result
-
+        idea of visual cryptography. Read the poster for more on that. The
+        optional scheme (a subpixelScheme, diagonalScheme by default) says
+        which grids to use; the shares of a cryptograph must all be
+        pixelcoded with the same scheme."""
+
+        if scheme is None:
+            scheme = diagonalScheme
+        width, height = self.size()
+        result = numpy.empty((2*height, _rowBytes(2*width)), numpy.uint8)
+        for y0, y1 in _bands(self.__bits, 4*self.__bits.shape[1]):
+            result[2*y0:2*y1] = scheme.expand(self.__bits[y0:y1], width, y0)
+        return bitmap((2*width, 2*height), result)
+
+
+# Helpers for the packed representation used by bitmap.
+
+# Operations on whole buffers work on bands of rows of about this many bytes,
+# so that the rows being combined stay in the processor's cache.
+_bandBytes = 256 * 1024
+
+def _rowBytes(width):
+    """Return the number of bytes taken by a packed row of width pixels."""
+    return (width + 7) // 8
+
+def _padMask(width):
+    """Return the mask that keeps the meaningful bits of the last byte of a
+    packed row of width pixels and clears the padding ones."""
+    used = width % 8 or 8
+    return (0xff << (8 - used)) & 0xff
+
+def _clearPadding(bits, width):
+    """Clear, in place, the padding bits of a packed buffer whose rows are
+    width pixels wide."""
+
+    if width and bits.shape[1]:
+        bits[:, -1] &= _padMask(width)
+
+def _bandRows(rowBytes):
+    """Return how many packed rows of rowBytes bytes make up a band."""
+    return max(1, _bandBytes // max(1, rowBytes))
+
+def _bands(bits, rowBytes=None):
+    """Return a list of (first, last+1) row ranges that split the packed
+    buffer bits into bands of roughly _bandBytes bytes each. If rowBytes is
+    given it overrides the width of the buffer's rows in this estimate."""
+
+    height = bits.shape[0]
+    if rowBytes is None:
+        rowBytes = bits.shape[1]
+    rows = _bandRows(rowBytes)
+    return [(y, min(y + rows, height)) for y in range(0, height, rows)]
+
+@_instrumented("decode", lambda args, result: _pixels(result[0]))
+def _decode(filename):
+    """Load the named image file with PIL and return a pair made of its
+    size and its pixels as a packed buffer (see _bitsFromImage())."""
+
+    raw = Image.open(filename)
+    return raw.size, _bitsFromImage(raw.convert("1"))
+
+def _bitsFromImage(image):
+    """Take a PIL image of type "1" and return its pixels as a packed
+    buffer in bitmap's internal representation."""
+
+    width, height = image.size
+    raw = numpy.fromstring(image.tobytes(), numpy.uint8)
+    bits = numpy.invert(raw.reshape(height, _rowBytes(width)))
+    _clearPadding(bits, width)
+    return bits
+
+def _imageFromBits(size, bits):
+    """The inverse of _bitsFromImage: take a size and a packed buffer and
+    return a new PIL image of type "1"."""
+
+    return Image.frombytes("1", size, numpy.invert(bits).tostring())
+
+
+def _keystream(seed, offset, length):
+    """Return length bytes (as a NumPy array of unsigned bytes) from
+    position offset onwards of the keystream determined by the string
+    seed. The keystream is SHA-256 in counter mode, so any stretch of it can
+    be produced without producing what comes before."""
+
+    first, last = offset // 32, (offset + length + 31) // 32
+    blocks = [hashlib.sha256(seed + struct.pack(">Q", i)).digest()
+              for i in xrange(first, last)]
+    start = offset - 32*first
+    return numpy.fromstring(
+        string.join(blocks, ""), numpy.uint8)[start:start+length]
+
+
+class subpixelScheme:
+    """A way of pixelcoding bitmaps. Each black pixel turns into a 2x2 grid
+    of subpixels drawn from a list of patterns, and each white pixel into
+    the complement of the pattern it would have had if it were black. With
+    a single pattern every pixel gets the same one; with several, each
+    pixel gets one picked at random, the same one for the same position
+    every time (so that a pad and a ciphertext pixelcoded with the same
+    scheme still match up)."""
 
+    # Private members:
+    # __patterns = array of the patterns, indexed by pattern, row, column
+    # __seed = the string that determines the choice of pattern per pixel
+    # __table = for a single pattern, the expansion of each possible byte
+    #           of 8 pixels into its two rows of 16 subpixels (2 bytes each)
+
+    def __init__(self, patterns, seed=None):
+        """Take a list of patterns, each being a pair of rows of two
+        subpixels (1 for black) and, for more than one pattern, an optional
+        seed string for choosing among them; if that's not given, a random
+        one is made up, so only this scheme object will reproduce the
+        choice."""
+
+        self.__patterns = numpy.array(patterns, numpy.uint8).reshape(-1, 2, 2)
+        self.__seed = None
+        self.__table = None
+        if len(self.__patterns) == 1:
+            bits = numpy.unpackbits(numpy.arange(256, dtype=numpy.uint8))
+            white = 1 - bits.reshape(256, 8, 1, 1)
+            grids = self.__patterns[0] ^ white
+            self.__table = numpy.packbits(
+                grids.transpose(0, 2, 1, 3).reshape(256, 2, 16), axis=-1)
+        else:
+            self.__seed = seed or os.urandom(16)
+
+    def patterns(self):
+        """Return the patterns used for black pixels."""
+        return self.__patterns.tolist()
+
+    def expand(self, bits, width, y0=0):
+        """Take a band of packed rows of a bitmap (see bitmap.buffer()) that
+        is width pixels wide and whose first row is row y0 of the whole
+        bitmap. Return the packed rows of the pixelcoded band, twice as many
+        and twice as wide."""
+
+        height = bits.shape[0]
+        if self.__table is not None:
+            # Look up both rows of subpixels for 8 pixels at a time.
+            grids = self.__table[bits].transpose(0, 2, 1, 3)
+            result = grids.reshape(2*height, 2*bits.shape[1])
+            result = result[:, :_rowBytes(2*width)]
+        else:
+            # Pick a pattern for every pixel and complement the white ones.
+            # Each row has its own keystream, so that a row gets the same
+            # patterns whatever band it comes in.
+            pixels = numpy.unpackbits(bits, axis=1)[:, :width]
+            last = len(self.__patterns) - 1
+            choice = numpy.empty((height, width), numpy.uint16)
+            for y in range(height):
+                choice[y] = _randomIntegers(
+                    width, 0, last, self.__seed + ":%d" % (y0 + y))
+            grids = self.__patterns[choice] ^ (1 - pixels)[:, :, None, None]
+            result = numpy.packbits(
+                grids.transpose(0, 2, 1, 3).reshape(2*height, 2*width), axis=1)
+        result = numpy.ascontiguousarray(result)
+        _clearPadding(result, 2*width)
+        return result
 
+# The classic scheme: each black pixel becomes a NW-SE diagonal pair of
+# subpixels, each white one a NE-SW pair.
+diagonalScheme = subpixelScheme([((1,0), (0,1))])
+# Black pixels become the top pair of subpixels, white ones the bottom pair.
+horizontalScheme = subpixelScheme([((1,1), (0,0))])
+# Black pixels become the left pair of subpixels, white ones the right pair.
+verticalScheme = subpixelScheme([((1,0), (1,0))])
+# Not for shares: each pixel just becomes four of the same colour.
+solidScheme = subpixelScheme([((1,1), (1,1))])
+
+def naorShamirScheme(seed=None):
+    """Return a subpixelScheme that, as in Naor and Shamir's paper, picks
+    for each pixel a random permutation of the columns of the 2 out of 2
+    basis matrices, i.e. any of the six ways of blacking out two subpixels
+    out of four, each equally likely. The choice is made by a keystream
+    based on the seed string (a random one if not supplied)."""
+
+    patterns = []
+    for first in range(4):
+        for second in range(first+1, 4):
+            grid = [0, 0, 0, 0]
+            grid[first] = grid[second] = 1
+            patterns.append((grid[0:2], grid[2:4]))
+    return subpixelScheme(patterns, seed)
+
+# The names by which front ends (vck-cli.py and friends) know the schemes.
+schemeNames = ["diagonal", "horizontal", "vertical", "naorshamir"]
+_seededSchemes = {}
+
+def namedScheme(name, seed=None):
+    """Return the subpixelScheme called name, one of schemeNames. For
+    "naorshamir" the seed string determines the patterns (see
+    naorShamirScheme()) and the same seed always gives back the same
+    scheme object, so that the pixelcoded pads the pads cache keeps for it
+    are found again. Without a seed the patterns are random: only the
+    object returned reproduces them, so a pad and a cryptograph made with
+    two different calls won't match."""
+
+    if name not in schemeNames:
+        raise ValueError, "unknown scheme " + name
+    if name != "naorshamir":
+        return globals()[name + "Scheme"]
+    if seed is None:
+        return naorShamirScheme()
+    scheme = _seededSchemes.get(seed)
+    if scheme is None:
+        scheme = _seededSchemes.setdefault(seed, naorShamirScheme(seed))
+    return scheme
+
+
+@_instrumented("boolean", lambda args, result: _pixels(result))
 def boolean(operation, bitmaps):
-    """Apply the boolean operation 'operation' (a binary function of two
-    integers returning an integer) to the list of bitmaps in 'bitmaps'
-    (precondition: the list can't be empty and the bitmaps must all have
-    the same size) and return the resulting bitmap."""
+    """Apply the boolean operation 'operation' to the list of bitmaps in
+    'bitmaps' (precondition: the list can't be empty and the bitmaps must
+    all have the same size) and return the resulting bitmap. The operation
+    may be a NumPy bitwise ufunc (numpy.bitwise_and and friends), which is
+    applied to the packed buffers a band of rows at a time, folding in all
+    the bitmaps before moving on to the next band; or any other binary
+    function of two integers returning an integer, which is applied pixel
+    by pixel by booleanByPixel(). If any of the bitmaps is a lazyBitmap,
+    nothing is worked out yet and the result is a lazyBitmap."""
+
+    for b in bitmaps:
+        if isinstance(b, lazyBitmap):
+            return lazyBitmap(None, "boolean", operation, bitmaps)
+    if not isinstance(operation, numpy.ufunc):
+        return booleanByPixel(operation, bitmaps)
+
+    size = bitmaps[0].size()
+    for b in bitmaps[1:]:
+        assert b.size() == size
+    buffers = [b.buffer() for b in bitmaps]
+    result = numpy.empty_like(buffers[0])
+    for y0, y1 in _bands(result):
+        band = result[y0:y1]
+        band[...] = buffers[0][y0:y1]
+        for other in buffers[1:]:
+            operation(band, other[y0:y1], band)
+    _clearPadding(result, size[0])
+    return bitmap(size, result)
+
+def booleanByPixel(operation, bitmaps):
+    """Same as boolean(), but with 'operation' being a binary function of
+    two integers returning an integer, applied to each pixel in turn. This
+    is the obvious but slow way of doing it, which is kept around as a
+    reference to check the fast one against."""
 
     maxX, maxY = size = bitmaps[0].size()
     result = bitmap(size)
@@ -179,14 +633,25 @@ def boolean(operation, bitmaps):
 # Take an arbitrary number (>=1) of bitmap arguments, all of the same size,
 # and return another bitmap resulting from their pixel-by-pixel AND, OR or
 # XOR as appropriate.
-def AND(*args): return boolean(lambda a,b:a&b, args)
-def OR(*args): return boolean(lambda a,b:a|b, args)
-def XOR(*args): return boolean(lambda a,b:a^b, args)
+def AND(*args): return boolean(numpy.bitwise_and, args)
+def OR(*args): return boolean(numpy.bitwise_or, args)
+def XOR(*args): return boolean(numpy.bitwise_xor, args)
 
 
 def NOT(bmp):
     """Take a bitmap and return its negative (obtained by swopping white
-    and black at each pixel)."""
+    and black at each pixel). The negative of a lazyBitmap is another
+    lazyBitmap."""
+
+    if isinstance(bmp, lazyBitmap):
+        return lazyBitmap(None, "not", None, (bmp,))
+    result = numpy.invert(bmp.buffer())
+    _clearPadding(result, bmp.size()[0])
+    return bitmap(bmp.size(), result)
+
+def NOTByPixel(bmp):
+    """Same as NOT(), but done pixel by pixel. Kept as a reference to check
+    NOT() against."""
 
     maxX, maxY = size = bmp.size()
     result = bitmap(size)
@@ -197,27 +662,68 @@ def NOT(bmp):
 
 
 
-def randomBitmap(size):
+def _randomBytes(length, seed=None, offset=0):
+    """Return length random bytes as a NumPy array of unsigned bytes. They
+    come from os.urandom, i.e. the operating system's cryptographically
+    strong RNG or, if a seed string is supplied, from position offset
+    onwards of the keystream it determines (reproducible, which is handy
+    for tests)."""
+
+    if seed is None:
+        return numpy.fromstring(os.urandom(length), numpy.uint8)
+    return _keystream(seed, offset, length)
+
+def _randomIntegers(count, low, high, seed=None):
+    """Return a NumPy array of count random integers in the range low..high
+    inclusive (high - low must be less than 2**32), each equally likely.
+    Two bytes of randomness (four if the range needs them) are drawn per
+    candidate and masked down to the smallest power of two that covers the
+    range; candidates that fall outside it are thrown away and more are
+    drawn, rather than taking them modulo the range, which would favour the
+    low values."""
+
+    span = high - low + 1
+    mask = 1
+    while mask < span:
+        mask = mask << 1
+    mask = mask - 1
+    if span <= 65536:
+        size, dtype = 2, numpy.uint16
+    else:
+        size, dtype = 4, numpy.uint32
+    result = numpy.empty(0, dtype)
+    offset = 0
+    while len(result) < count:
+        # Ask for a bit more than we need, since some will be rejected.
+        wanted = (count - len(result)) * (mask + 1) // span + 16
+        raw = _randomBytes(size*wanted, seed, offset)
+        offset = offset + size*wanted
+        candidates = raw.view(">u%d" % size) & mask
+        result = numpy.concatenate(
+            (result, candidates[candidates < span].astype(dtype)))
+    return result[:count] + low
+
+@_instrumented("randomBitmap", lambda args, result: _pixels(result))
+def randomBitmap(size, seed=None):
     """Take a size (2-tuple of x and y) and return a bitmap of that size
-    filled with random pixels. WARNING! THE CODE HERE IS ONLY FOR
-    DEMONSTRATION PURPOSES, SINCE IT CALLS THE STANDARD PYTHON RANDOM
-    NUMBER GENERATOR, which is fine for statistics but not good enough for
-    crypto. For real use, substitute this with really random data from an
-    external source, or at least with a properly seeded cryptographically
-    strong RNG."""
-
-    b = bitmap(size)
-    xmax, ymax = size
-    for x in xrange(xmax):
-        for y in xrange(ymax):
-            b.set(x, y, random.randint(0,1))
-    return b
+    filled with random pixels. The pixels are taken in bulk from os.urandom,
+    the operating system's cryptographically strong RNG, unless a seed
+    string is supplied, in which case they come from a keystream determined
+    by the seed (same seed, same bitmap: good for tests, but then the pad
+    is only as secret as the seed)."""
+
+    width, height = size
+    rowBytes = _rowBytes(width)
+    bits = _randomBytes(height*rowBytes, seed).reshape(height, rowBytes)
+    _clearPadding(bits, width)
+    return bitmap(size, bits)
 
 
 class _viewer:
     """A toplevel window with a canvas."""
 
     def __init__(self, root, width, height, title="Unnamed VCK image"):
+        _importGUI()
         self.__width = width
         self.__height = height
         self._t = Tkinter.Toplevel(root)
@@ -229,6 +735,11 @@ class _viewer:
         self._t.update()
 
 
+    def size(self):
+        """Return a 2-tuple (width, height) with the size of the canvas."""
+        return self.__width, self.__height
+
+    @_instrumented("psprint", lambda args, result: _pixels(args[0]))
     def psprint(self, filename):
         """Write a postscript representation of the canvas to the specified
         file."""
@@ -285,11 +796,12 @@ class _bitmapViewer(_viewer):
         self._t.update()
 
 
-def encrypt(rawPlaintext, rawPad = None):
+@_instrumented("encrypt", lambda args, result: _pixels(args[0]))
+def encrypt(rawPlaintext, rawPad = None, scheme = None):
     """Take a plaintext bitmap and, optionally, a supposedly random pad of
-    the same size (one will be made up on the spot if not supplied). Return
-    a 2-tuple containing the large pixelcoded versions of ciphertext and
-    pad."""
+    the same size (one will be made up on the spot if not supplied) and a
+    subpixelScheme for the pixelcoding. Return a 2-tuple containing the
+    large pixelcoded versions of ciphertext and pad."""
 
     # The raw versions are the same size as the original rawPlaintext
     if not rawPad:
@@ -297,11 +809,42 @@ def encrypt(rawPlaintext, rawPad = None):
     rawCiphertext = XOR(rawPlaintext, rawPad)
 
     # The final versions are linearly twice as big due to pixelcoding
-    ciphertext = rawCiphertext.pixelcode()
-    pad = rawPad.pixelcode()
+    ciphertext = rawCiphertext.pixelcode(scheme)
+    pad = rawPad.pixelcode(scheme)
 
     return ciphertext, pad
 
+@_instrumented("encryptFused", lambda args, result: _pixels(args[0]))
+def encryptFused(rawPlaintext, rawPad = None, scheme = None):
+    """Same as encrypt(), and giving exactly the same results for the same
+    pad and scheme, but without making the raw ciphertext (nor, if it has
+    to be made up, the whole raw pad) as intermediate bitmaps: each band of
+    rows of plaintext and pad is XORed and pixelcoded straight into the two
+    final bitmaps before moving on to the next band."""
+
+    if scheme is None:
+        scheme = diagonalScheme
+    width, height = size = rawPlaintext.size()
+    plain = rawPlaintext.buffer()
+    if rawPad is not None:
+        assert rawPad.size() == size
+    expandedSize = (2*width, 2*height)
+    shape = (2*height, _rowBytes(2*width))
+    ciphertext = numpy.empty(shape, numpy.uint8)
+    pad = numpy.empty(shape, numpy.uint8)
+
+    for y0, y1 in _bands(plain, 4*plain.shape[1]):
+        if rawPad is None:
+            padBand = _randomBytes(plain[y0:y1].size).reshape(y1-y0, -1)
+            _clearPadding(padBand, width)
+        else:
+            padBand = rawPad.buffer()[y0:y1]
+        cipherBand = numpy.bitwise_xor(plain[y0:y1], padBand)
+        ciphertext[2*y0:2*y1] = scheme.expand(cipherBand, width, y0)
+        pad[2*y0:2*y1] = scheme.expand(padBand, width, y0)
+
+    return bitmap(expandedSize, ciphertext), bitmap(expandedSize, pad)
+
 def decrypt(ciphertext, pad):
     """Actually the decription ought to be performed without a computer
     (the whole point of visual cryptography), by just superimposing the
@@ -318,6 +861,7 @@ def mainApp(function):
     Tkinter, running its main loop and ensuring that windows don't
     disappear unexpectedly."""
 
+    _importGUI()
     root = Tkinter.Tk()
     quit = Tkinter.Button(root, text="Quit", command=root.quit)
     quit.pack()
@@ -328,6 +872,627 @@ def mainApp(function):
     root.update()
     root.mainloop()
 
+# --------------------------------------------------------------
+# Lazy evaluation
+
+# Chains of operations such as OR(XOR(a, pad).pixelcode(), pad.pixelcode())
+# normally make every intermediate bitmap in full. Wrapping the operands in
+# lazy() makes AND, OR, XOR, NOT, pixelcode and crop build a graph of
+# lazyBitmaps instead, which is only evaluated, a band of rows at a time
+# and with no intermediate bitmaps, when its pixels are asked for by
+# write(), get(), view() and friends.
+
+def lazy(bmp):
+    """Take a bitmap and return a lazyBitmap standing for it, so that the
+    operations on it are deferred (see lazyBitmap)."""
+
+    return lazyBitmap(bmp)
+
+class lazyBitmap:
+    """A bitmap whose pixels are only worked out when they are needed: the
+    result of an operation on bitmaps and lazyBitmaps, remembered as the
+    operation and its operands. A lazyBitmap has the same methods as a
+    bitmap, apart from set(), so it can be used wherever a bitmap is only
+    read. Identical subexpressions (the same operation on the same
+    operands, even if they were built separately) are only evaluated once
+    per band."""
+
+    # Private members:
+    # __operation = "bitmap" for a plain bitmap, or one of "boolean",
+    #               "not", "pixelcode" and "crop"
+    # __argument = the bitmap for "bitmap", the NumPy ufunc (or binary
+    #              function) for "boolean", the scheme for "pixelcode", the
+    #              box for "crop"
+    # __operands = the tuple of lazyBitmaps operated on
+    # __size = the size in pixels
+    # __key = a hashable description of the whole expression, equal for
+    #         equal expressions
+
+    def __init__(self, bmp, operation="bitmap", argument=None, operands=()):
+        """The allowed forms for the constructor are:
+        1- vck.lazyBitmap(aBitmap)
+            ...i.e. standing for a bitmap (or lazyBitmap), as lazy() does;
+        2- vck.lazyBitmap(None, operation, argument, operands)
+            ...which is what the operations do, so you won't need it."""
+
+        if isinstance(bmp, lazyBitmap):
+            self.__dict__.update(bmp.__dict__)
+            return
+        self.__operation = operation
+        self.__operands = tuple([lazyBitmap(o) for o in operands])
+        if operation == "bitmap":
+            self.__argument = bmp
+            self.__size = bmp.size()
+            self.__key = ("bitmap", id(bmp))
+            return
+
+        self.__argument = argument
+        keys = tuple([o.__key for o in self.__operands])
+        first = self.__operands[0].size()
+        if operation == "boolean":
+            for o in self.__operands[1:]:
+                assert o.size() == first
+            self.__size = first
+            self.__key = ("boolean", argument, keys)
+        elif operation == "not":
+            self.__size = first
+            self.__key = ("not", keys)
+        elif operation == "pixelcode":
+            self.__size = (2*first[0], 2*first[1])
+            self.__key = ("pixelcode", id(argument), keys)
+        elif operation == "crop":
+            left, top, right, bottom = argument
+            assert 0 <= left <= right <= first[0]
+            assert 0 <= top <= bottom <= first[1]
+            self.__size = (right - left, bottom - top)
+            self.__key = ("crop", tuple(argument), keys)
+        else:
+            raise ValueError, "unknown operation " + repr(operation)
+
+    def size(self):
+        """Return a 2-tuple (width, height) in pixels."""
+        return self.__size
+
+    def pixelcode(self, scheme=None):
+        """Same as bitmap.pixelcode(), but deferred."""
+
+        if scheme is None:
+            scheme = diagonalScheme
+        return lazyBitmap(None, "pixelcode", scheme, (self,))
+
+    def crop(self, box):
+        """Same as bitmap.crop(), but deferred."""
+        return lazyBitmap(None, "crop", box, (self,))
+
+    def rows(self, y0, y1, memo=None):
+        """Return the packed rows y0 to y1-1 of this lazyBitmap (see
+        bitmap.buffer()), working out only what they depend on. memo is a
+        dictionary of the rows of subexpressions already worked out, which
+        the caller may pass in to share them between several calls."""
+
+        if memo is None:
+            memo = {}
+        key = (self.__key, y0, y1)
+        if key in memo:
+            return memo[key]
+
+        width = self.__size[0]
+        operation, argument = self.__operation, self.__argument
+        if operation == "bitmap":
+            result = argument.buffer()[y0:y1]
+        elif operation == "boolean":
+            bands = [o.rows(y0, y1, memo) for o in self.__operands]
+            if isinstance(argument, numpy.ufunc):
+                result = bands[0].copy()
+                for other in bands[1:]:
+                    argument(result, other, result)
+                _clearPadding(result, width)
+            else:
+                result = boolean(argument, [bitmap((width, y1 - y0), b)
+                                            for b in bands]).buffer()
+        elif operation == "not":
+            result = numpy.invert(self.__operands[0].rows(y0, y1, memo))
+            _clearPadding(result, width)
+        elif operation == "pixelcode":
+            # Expand the rows of the operand that cover the ones wanted,
+            # then keep just those.
+            first, last = y0 // 2, (y1 + 1) // 2
+            band = self.__operands[0].rows(first, last, memo)
+            result = argument.expand(band, width // 2, first)
+            result = result[y0 - 2*first:y1 - 2*first]
+        else:
+            left, top, right, bottom = argument
+            band = self.__operands[0].rows(top + y0, top + y1, memo)
+            whole = bitmap((self.__operands[0].size()[0], y1 - y0), band)
+            result = whole.crop((left, 0, right, y1 - y0)).buffer()
+        memo[key] = result
+        return result
+
+    def bands(self):
+        """Return an iterator over the packed rows of this lazyBitmap, a
+        band at a time."""
+
+        width, height = self.__size
+        step = _bandRows(_rowBytes(width))
+        for y0 in range(0, height, step):
+            yield self.rows(y0, min(y0 + step, height))
+
+    @_instrumented("lazyEvaluate", lambda args, result: _pixels(args[0]))
+    def evaluate(self):
+        """Work out all the pixels and return them as a bitmap."""
+
+        if self.__operation == "bitmap":
+            return self.__argument
+        width, height = self.__size
+        result = numpy.empty((height, _rowBytes(width)), numpy.uint8)
+        y = 0
+        for band in self.bands():
+            result[y:y + len(band)] = band
+            y = y + len(band)
+        return bitmap(self.__size, result)
+
+    def get(self, x, y):
+        """Return the value of the pixel at x, y, working out just its row."""
+
+        x, y = int(x), int(y)
+        if not (0 <= x < self.__size[0] and 0 <= y < self.__size[1]):
+            raise IndexError, "image index out of range"
+        return bool(self.rows(y, y + 1)[0, x >> 3] & (0x80 >> (x & 7)))
+
+    def buffer(self):
+        """Return the packed pixel buffer of the evaluated bitmap."""
+        return self.evaluate().buffer()
+
+    def image(self):
+        """Return a new PIL image of type "1" with the same pixels."""
+        return self.evaluate().image()
+
+    def view(self, root, title="No name"):
+        """Same as bitmap.view(), evaluating the pixels first."""
+        return self.evaluate().view(root, title)
+
+    @_instrumented("lazyWrite", lambda args, result: _pixels(args[0]))
+    def write(self, filename):
+        """Same as bitmap.write(). Raw PBM and TIFF files are written a band
+        at a time as the pixels are worked out, without ever holding the
+        whole bitmap in memory; other types are evaluated first."""
+
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in (".pbm", ".pnm", ".tif", ".tiff"):
+            self.evaluate().write(filename)
+            return
+        writer = _bandWriter(filename, self.__size)
+        try:
+            for band in self.bands():
+                writer.write(band)
+        finally:
+            writer.close()
+
+
+# --------------------------------------------------------------
+# k out of n threshold schemes
+
+# Naor and Shamir's paper also shows how to split a picture into n shares
+# such that any k of them, superimposed, reveal it, while any k-1 of them
+# give away nothing at all. Each pixel becomes a block of subpixels, one
+# row of a basis matrix per share: S0 for white pixels, S1 for black ones,
+# with the columns shuffled by a random permutation for every pixel.
+#
+# The basis matrices built here are "symmetric": the columns of S0 and S1
+# are all the columns of n bits of some weights (number of 1s), each taken
+# a certain number of times. If d(w) is the number of times weight w
+# appears in S0 minus the number of times it appears in S1, then
+#     - any k-1 rows of S0 and S1 look the same, once the columns are
+#       shuffled, when sum_w d(w) * C(n-k+1, w-j) = 0 for j = 0..k-1, and
+#     - t superimposed rows of S0 have sum_w d(w) * C(n-t, w) more white
+#       subpixels than those of S1, which must be more than 0 for t >= k.
+# The first condition fixes d(0)..d(k-1) from the others; d(k)..d(n) are
+# searched over small values for the greatest relative contrast and then
+# the fewest subpixels. For 2 out of 2 this finds Naor and Shamir's
+# matrices; for 3 out of 5, a block of 8 subpixels with a contrast of 1.
+
+def _choose(n, k):
+    """Return the binomial coefficient C(n, k), 0 if k is out of range."""
+
+    if k < 0 or k > n:
+        return 0
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+def _thresholdWeights(k, n):
+    """Return the list of the d(w), w = 0..n (see above) of the best
+    symmetric k out of n scheme, searching each free d(w) over -R..R with
+    R as large as a few hundred thousand candidates allow."""
+
+    free = n + 1 - k
+    reach = 1
+    while (2*reach + 3) ** free <= 200000:
+        reach = reach + 1
+    grid = numpy.indices((2*reach + 1,) * free).reshape(free, -1).T - reach
+    d = numpy.zeros((len(grid), n + 1), numpy.int64)
+    d[:, k:] = grid
+    # Row j of the security conditions has a 1 in column j and 0s before
+    # it, so d(k-1)..d(0) follow one by one.
+    for j in range(k - 1, -1, -1):
+        row = numpy.array([_choose(n-k+1, w-j) for w in range(j+1, n+1)])
+        d[:, j] = -(d[:, j+1:] * row).sum(axis=1)
+    stacked = numpy.array([[_choose(n-t, w) for w in range(n+1)]
+                           for t in range(k, n+1)])
+    contrasts = d.dot(stacked.T)
+    good = (contrasts > 0).all(axis=1)
+    columns = numpy.array([_choose(n, w) for w in range(n+1)])
+    m = (numpy.maximum(d, 0) * columns).sum(axis=1)
+    d, contrasts, m = d[good], contrasts[good, 0], m[good]
+    best = numpy.lexsort((m, m / contrasts.astype(float)))[0]
+    return d[best].tolist()
+
+# The basis matrices and column permutations of the k out of n schemes made
+# so far, by (k, n).
+_thresholdCache = {}
+
+# Below this many subpixels per block all their permutations are tabulated
+# and picked by number; above, each pixel's is made by sorting random keys.
+_permutationTableLimit = 9
+
+def _thresholdBasis(k, n):
+    """Return, for a k out of n scheme, a 4-tuple of: the basis matrices as
+    a NumPy array indexed by [pixel, share, subpixel] (S0 for pixel 0,
+    white, S1 for pixel 1, black), each padded with white columns up to a
+    square number of subpixels; the side of that square; the contrast; and
+    a table of all the permutations of the subpixels, or None if there
+    would be too many. All of it is cached."""
+
+    key = (k, n)
+    if key not in _thresholdCache:
+        d = _thresholdWeights(k, n)
+        matrices = [[], []]
+        for w in range(n + 1):
+            for ones in itertools.combinations(range(n), w):
+                column = [0] * n
+                for i in ones:
+                    column[i] = 1
+                if d[w] > 0:
+                    matrices[0].extend([column] * d[w])
+                elif d[w] < 0:
+                    matrices[1].extend([column] * -d[w])
+        m = len(matrices[0])
+        side = 1
+        while side*side < m:
+            side = side + 1
+        for matrix in matrices:
+            matrix.extend([[0] * n] * (side*side - m))
+        basis = numpy.array(matrices, numpy.uint8).transpose(0, 2, 1)
+        contrast = sum([d[w] * _choose(n-k, w) for w in range(n + 1)])
+        table = None
+        if side*side <= _permutationTableLimit:
+            table = numpy.array(list(itertools.permutations(range(side*side))),
+                                numpy.uint8)
+        _thresholdCache[key] = (basis, side, contrast, table)
+    return _thresholdCache[key]
+
+class thresholdScheme:
+    """A k out of n visual secret sharing scheme: split() turns a bitmap
+    into n shares, each made of square blocks of subpixels, any k of which
+    superimposed (OR them together) reveal the picture while fewer reveal
+    nothing."""
+
+    def __init__(self, k, n):
+        """Take the number k of shares needed to see the picture out of the
+        number n of shares made (2 <= k <= n)."""
+
+        if not 2 <= k <= n:
+            raise ValueError, "need 2 <= k <= n, not k=%d n=%d" % (k, n)
+        self.k, self.n = k, n
+        self.__basis, self.__side, self.__contrast, self.__table = \
+                      _thresholdBasis(k, n)
+
+    def basis(self):
+        """Return the pair of basis matrices (S0 for white pixels, S1 for
+        black ones) as lists of rows, one row of subpixels per share."""
+        return self.__basis[0].tolist(), self.__basis[1].tolist()
+
+    def side(self):
+        """Return the side, in subpixels, of the block each pixel becomes."""
+        return self.__side
+
+    def contrast(self):
+        """Return by how many subpixels a black block of k superimposed
+        shares outnumbers a white one in black subpixels."""
+        return self.__contrast
+
+    def split(self, plaintext, seed=None):
+        """Take a bitmap and return the list of its n shares, each as many
+        times bigger, in each direction, as side() says. The permutations
+        of the subpixels come from os.urandom or, if a seed string is
+        supplied, from the keystream it determines."""
+
+        width, height = plaintext.size()
+        side, count = self.__side, self.__side * self.__side
+        bits = plaintext.buffer()
+        shares = [numpy.empty((side*height, _rowBytes(side*width)),
+                              numpy.uint8) for i in range(self.n)]
+        rows = max(1, _bandBytes // (width * self.n * count))
+        for y0 in range(0, height, rows):
+            y1 = min(y0 + rows, height)
+            if seed is None:
+                bandSeed = None
+            else:
+                bandSeed = seed + ":%d" % y0
+            pixels = numpy.unpackbits(bits[y0:y1], axis=1)[:, :width]
+            if self.__table is not None:
+                choice = _randomIntegers((y1-y0) * width, 0,
+                                         len(self.__table) - 1, bandSeed)
+                permutations = self.__table[choice]
+            else:
+                keys = _randomBytes(4 * (y1-y0) * width * count, bandSeed)
+                permutations = numpy.argsort(
+                    keys.view(">u4").reshape(-1, count), axis=1)
+            permutations = permutations.reshape(y1-y0, width, 1, count)
+            blocks = numpy.take_along_axis(self.__basis[pixels],
+                                           permutations, axis=3)
+            for i in range(self.n):
+                grid = blocks[:, :, i].reshape(y1-y0, width, side, side)
+                grid = grid.transpose(0, 2, 1, 3).reshape(
+                    side*(y1-y0), side*width)
+                shares[i][side*y0:side*y1] = numpy.packbits(grid, axis=1)
+        return [bitmap((side*width, side*height), share) for share in shares]
+
+
+# --------------------------------------------------------------
+# Halftoning
+
+# Turning a greyscale picture into black and white dots that look grey
+# from a distance, so that it can go through the (fast) monochrome
+# machinery instead of being drawn as halfmoons. bitmap("picture.jpg")
+# just leaves that to PIL; halftone() offers a choice of methods:
+#     - "bayer": ordered dither with a Bayer matrix, tiled;
+#     - "bluenoise": ordered dither with a blue noise mask (made by
+#       Ulichney's void and cluster method), which looks less regular;
+#     - "floydsteinberg": Floyd and Steinberg's error diffusion;
+#     - "threshold": everything darker than mid grey becomes black.
+
+# The threshold matrices made so far, by method and size.
+_ditherCache = {}
+
+def _bayerMatrix(order):
+    """Return the Bayer matrix of the given order (a power of 2): an array
+    of the numbers 0..order*order-1 in which consecutive numbers are as
+    far apart as possible."""
+
+    matrix = numpy.zeros((1, 1), numpy.int64)
+    while len(matrix) < order:
+        matrix = numpy.vstack((
+            numpy.hstack((4*matrix, 4*matrix + 2)),
+            numpy.hstack((4*matrix + 3, 4*matrix + 1))))
+    return matrix
+
+def _blueNoiseMatrix(size, sigma=1.5):
+    """Return a size x size array of the numbers 0..size*size-1 ranked by
+    the void and cluster method, so that thresholding it at any level gives
+    evenly spread dots with no pattern. The same one comes out every time
+    (it starts from a keystream, not from os.urandom)."""
+
+    count = size * size
+    d = numpy.minimum(numpy.arange(size), size - numpy.arange(size))
+    kernel = numpy.exp(-(d[:, None]**2 + d[None, :]**2) / (2.0 * sigma**2))
+
+    def energy(points):
+        # The sum of a kernel on each point, wrapping around the edges,
+        # i.e. a circular convolution.
+        return numpy.real(numpy.fft.ifft2(
+            numpy.fft.fft2(points) * numpy.fft.fft2(kernel)))
+
+    def shifted(index):
+        y, x = divmod(index, size)
+        return numpy.roll(numpy.roll(kernel, y, 0), x, 1).ravel()
+
+    # An initial pattern of about a tenth of the pixels, spread out by
+    # moving the tightest cluster into the largest void until that settles.
+    points = (_keystream("vck blue noise", 0, count) < 26).ravel()
+    field = energy(points.reshape(size, size)).ravel()
+    while 1:
+        cluster = numpy.where(points, field, -numpy.inf).argmax()
+        points[cluster] = 0
+        field = field - shifted(cluster)
+        void = numpy.where(points, numpy.inf, field).argmin()
+        points[void] = 1
+        field = field + shifted(void)
+        if void == cluster:
+            break
+
+    ranks = numpy.zeros(count, numpy.int64)
+    ones = points.sum()
+    # Number the initial points by taking away tightest clusters...
+    remaining, remainingField = points.copy(), field.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = numpy.where(remaining, remainingField, -numpy.inf).argmax()
+        remaining[cluster] = 0
+        remainingField = remainingField - shifted(cluster)
+        ranks[cluster] = rank
+    # ...and the rest by filling in largest voids.
+    for rank in range(ones, count):
+        void = numpy.where(points, numpy.inf, field).argmin()
+        points[void] = 1
+        field = field + shifted(void)
+        ranks[void] = rank
+    return ranks.reshape(size, size)
+
+def _ditherMatrix(method, size):
+    """Return the cached matrix of grey levels (0..255, as floats) below
+    which pixels turn black, for "bayer" or "bluenoise" of the given
+    size."""
+
+    key = (method, size)
+    if key not in _ditherCache:
+        if method == "bayer":
+            ranks = _bayerMatrix(size)
+        else:
+            ranks = _blueNoiseMatrix(size)
+        _ditherCache[key] = (ranks + 0.5) * 255.0 / ranks.size
+    return _ditherCache[key]
+
+def _floydSteinberg(pixels, bits):
+    """Halftone the greyscale pixels (an array of unsigned bytes indexed by
+    [y, x]) by Floyd-Steinberg error diffusion, into the packed buffer
+    bits, giving exactly the same result as the usual pixel by pixel loop.
+
+    Each pixel depends on the ones before it on its row and on the row
+    above up to one to its right, so all the pixels with the same x + 2y
+    can be worked out at once. The rows are taken in strips, each held
+    skewed and transposed (pixel x, y of the strip at [x + 2y, y]) so that
+    every such wavefront is a contiguous row of the array; the error
+    diffused out of the bottom of a strip is carried into the next."""
+
+    height, width = pixels.shape
+    rows = max(1, min(height, 2048, (16 << 20) // (4 * (width + 1))))
+    carry = numpy.zeros(width, numpy.float32)
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        strip = y1 - y0
+        ys = numpy.arange(strip)[:, None]
+        xs = numpy.arange(width)[None, :]
+        skewed = numpy.zeros((width + 2*strip + 3, strip + 1), numpy.float32)
+        skewed[xs + 2*ys, ys] = pixels[y0:y1] / numpy.float32(255)
+        skewed[numpy.arange(width), 0] += carry
+        black = numpy.zeros(skewed.shape, numpy.bool_)
+        for t in range(width + 2*strip - 2):
+            first = max(0, (t - width + 2) // 2)
+            last = min(strip, t // 2 + 1)
+            values = skewed[t, first:last]
+            ink = values < 0.5
+            black[t, first:last] = ink
+            error = values - 1 + ink
+            skewed[t + 1, first:last] += error * numpy.float32(7 / 16.0)
+            skewed[t + 1, first + 1:last + 1] += error * numpy.float32(3 / 16.0)
+            skewed[t + 2, first + 1:last + 1] += error * numpy.float32(5 / 16.0)
+            skewed[t + 3, first + 1:last + 1] += error * numpy.float32(1 / 16.0)
+        bits[y0:y1] = numpy.packbits(black[xs + 2*ys, ys], axis=1)
+        carry = skewed[numpy.arange(width) + 2*strip, strip]
+
+@_instrumented("halftone", lambda args, result: _pixels(result))
+def halftone(image, method="floydsteinberg", size=None):
+    """Take a greyscale image (PIL type "L", or anything PIL can convert to
+    that, or the name of a file holding one) and return a bitmap of the
+    same size in which it is rendered by black and white dots, by the
+    given method (see above). size is the side of the matrix for "bayer"
+    (a power of 2, 8 by default) and "bluenoise" (64 by default). Raise
+    ValueError for an unknown method or an unsuitable size."""
+
+    pixels = _greyPixels(image)
+    height, width = pixels.shape
+    bits = numpy.empty((height, _rowBytes(width)), numpy.uint8)
+    if method == "floydsteinberg":
+        _floydSteinberg(pixels, bits)
+    elif method in ("bayer", "bluenoise", "threshold"):
+        if method == "threshold":
+            matrix = numpy.array([[127.5]])
+        else:
+            if size is None:
+                size = {"bayer": 8, "bluenoise": 64}[method]
+            if size < 1 or method == "bayer" and size & (size - 1):
+                raise ValueError, "bad matrix size %r for %s" % (size, method)
+            matrix = _ditherMatrix(method, size)
+        side = len(matrix)
+        tiled = numpy.tile(matrix, (1, (width + side - 1) // side))[:, :width]
+        for y0, y1 in _bands(bits, width):
+            black = pixels[y0:y1] < tiled[numpy.arange(y0, y1) % side]
+            bits[y0:y1] = numpy.packbits(black, axis=1)
+    else:
+        raise ValueError, "unknown halftoning method " + repr(method)
+    _clearPadding(bits, width)
+    return bitmap((width, height), bits)
+
+
+# --------------------------------------------------------------
+# Colour
+
+# Colour works like printing: a picture is separated into how much cyan,
+# magenta and yellow ink it needs (the complements of its red, green and
+# blue), each channel is halftoned into a bitmap of ink dots, and each
+# channel bitmap is encrypted on its own, with its own pad. A colour share
+# is the three channels of a share printed on top of each other in their
+# inks; superimposing two transparencies ORs the ink in each channel, so
+# each channel decrypts just as a monochrome picture would, in its ink.
+# Channels are lists of three bitmaps, cyan, magenta and yellow.
+
+def colourSeparate(image, halftoneMethod="floydsteinberg"):
+    """Take a colour image (anything PIL can convert to "RGB", or the name
+    of a file holding one) and return its cyan, magenta and yellow channels
+    as bitmaps in which black is ink, halftoned by the given method (see
+    halftone())."""
+
+    if type(image) == type(""):
+        image = Image.open(image)
+    return [halftone(channel, halftoneMethod)
+            for channel in image.convert("RGB").split()]
+
+@_instrumented("encryptColour", lambda args, result: 3*_pixels(args[0][0]))
+def encryptColour(channels, pads=None, scheme=None):
+    """Take the three channel bitmaps of a colour plaintext and,
+    optionally, three pads of the same size (made up on the spot if not
+    supplied) and a subpixelScheme. Return a 2-tuple of the pixelcoded
+    ciphertext channels and pad channels. All three channels are done in
+    a single pass, a band of rows at a time, as in encryptFused()."""
+
+    if scheme is None:
+        scheme = diagonalScheme
+    width, height = size = channels[0].size()
+    for c in channels[1:] + list(pads or []):
+        assert c.size() == size
+    expandedSize = (2*width, 2*height)
+    shape = (2*height, _rowBytes(2*width))
+    ciphertext = [numpy.empty(shape, numpy.uint8) for c in channels]
+    pad = [numpy.empty(shape, numpy.uint8) for c in channels]
+
+    plain = [c.buffer() for c in channels]
+    for y0, y1 in _bands(plain[0], 12*plain[0].shape[1]):
+        for i in range(len(channels)):
+            if pads is None:
+                padBand = _randomBytes(plain[i][y0:y1].size).reshape(y1-y0, -1)
+                _clearPadding(padBand, width)
+            else:
+                padBand = pads[i].buffer()[y0:y1]
+            cipherBand = numpy.bitwise_xor(plain[i][y0:y1], padBand)
+            ciphertext[i][2*y0:2*y1] = scheme.expand(cipherBand, width, y0)
+            pad[i][2*y0:2*y1] = scheme.expand(padBand, width, y0)
+
+    return ([bitmap(expandedSize, c) for c in ciphertext],
+            [bitmap(expandedSize, p) for p in pad])
+
+def decryptColour(ciphertext, pad):
+    """Simulate superimposing two colour shares (lists of channels): OR
+    each channel. See colourImage() for what it looks like."""
+
+    return [OR(c, p) for c, p in zip(ciphertext, pad)]
+
+def colourImage(channels):
+    """Return a PIL "RGB" image of the given cyan, magenta and yellow
+    channels printed in their inks (e.g. to save a colour share)."""
+
+    width, height = channels[0].size()
+    pixels = numpy.empty((height, width, 3), numpy.uint8)
+    for y0, y1 in _bands(channels[0].buffer(), 3*width):
+        for i in range(3):
+            ink = numpy.unpackbits(channels[i].buffer()[y0:y1], axis=1)
+            # Ink in a channel takes away its complementary primary.
+            pixels[y0:y1, :, i] = (ink[:, :width] ^ 1) * 255
+    return Image.fromarray(pixels, "RGB")
+
+def splitImageColour(image, shareFile1="share1.png", shareFile2="share2.png",
+                     scheme=None, halftoneMethod="floydsteinberg"):
+    """Like splitImage, but for a colour image (see colourSeparate()): write
+    two colour shares that, printed on transparencies and superimposed,
+    yield the image. Return the channels of the two shares."""
+
+    ciphertext, pad = encryptColour(colourSeparate(image, halftoneMethod),
+                                    None, scheme)
+    colourImage(pad).save(shareFile1)
+    colourImage(ciphertext).save(shareFile2)
+    return pad, ciphertext
+
+
 # --------------------------------------------------------------
 # Analog (greyscale) version
 
@@ -381,57 +1546,157 @@ class moonfield:
     mod = discretePi*2
     i2d = 360.0 / mod # integer to degree conversion factor
 
-    def __init__(self, size, filler=None):
-        """Make a moonfield of the specified size. If a filler function is
-        specified, fill it with it, otherwise leave the data
+    # Private members:
+    # __xmax, __ymax = the size
+    # __data = None if uninitialised, otherwise a NumPy array of unsigned
+    #          16-bit integers holding the angles, indexed by [y, x]
+
+    def __init__(self, size, filler=None, vectorized=0):
+        """Make a moonfield of the specified size. If a filler is
+        specified, fill it with it (see fill()), otherwise leave the data
         uninitialised."""
 
-        self.__data = {}
+        self.__data = None
         self.__xmax, self.__ymax = size
-        if filler:
-            self.fill(filler)
+        if filler is not None:
+            self.fill(filler, vectorized)
 
     def size(self):
         """Return a 2-tuple with the dimensions of the moonfield."""
         return self.__xmax, self.__ymax
 
-    def fill(self, filler):
-        """Take a function f(x,y) that accepts a position in the moonfield
-        and returns an integer value. Fill every cell in the moonfield with
-        the value returned by the filler (taken modulo mod)."""
-
-        for x in range(self.__xmax):
-            for y in range(self.__ymax):
-                self.__data[(x,y)] = filler(x,y) % self.mod
-
-    def randomFill(self, low=0, high=mod-1):
+    def data(self):
+        """Return the angles themselves (not a copy), as a NumPy array of
+        unsigned 16-bit integers indexed by [y, x], or None if the
+        moonfield is uninitialised."""
+
+        return self.__data
+
+    def fill(self, filler, vectorized=0):
+        """Fill every cell in the moonfield with an integer value (taken
+        modulo mod). The filler can be a function f(x,y) that accepts a
+        position in the moonfield and returns the value for that cell; or,
+        if vectorized is true, a function f(xs,ys) that accepts two NumPy
+        arrays with the x and y of every cell (indexed by [y, x]) and
+        returns an array of the values; or directly an array (or a list of
+        rows) of values indexed by [y, x]."""
+
+        shape = (self.__ymax, self.__xmax)
+        if callable(filler):
+            if vectorized:
+                ys, xs = numpy.indices(shape)
+                values = filler(xs, ys)
+            else:
+                values = numpy.empty(shape, numpy.int64)
+                for x in range(self.__xmax):
+                    for y in range(self.__ymax):
+                        values[y, x] = filler(x,y)
+        else:
+            values = filler
+        data = numpy.empty(shape, numpy.uint16)
+        data[...] = numpy.asarray(values) % self.mod
+        self.__data = data
+        if _collectors:
+            _noteAllocation(data, 0)
+
+    def __getitem__(self, position):
+        """Return the angle of the cell at position x, y, as in
+        moonfield[x, y]."""
+
+        x, y = position
+        return int(self.__data[y, x])
+
+    def __setitem__(self, position, value):
+        """Set the angle of the cell at position x, y (taken modulo mod), as
+        in moonfield[x, y] = value. Precondition: the moonfield must have
+        been filled already."""
+
+        x, y = position
+        self.__data[y, x] = value % self.mod
+
+    def __setstate__(self, state):
+        # Moonfields pickled by older versions kept their angles in a
+        # dictionary keyed by (x, y): turn that into an array.
+        data = state.get("_moonfield__data")
+        if type(data) == type({}):
+            if data:
+                xmax, ymax = state["_moonfield__xmax"], state["_moonfield__ymax"]
+                array = numpy.empty((ymax, xmax), numpy.uint16)
+                for (x, y), value in data.items():
+                    array[y, x] = value
+                state["_moonfield__data"] = array
+            else:
+                state["_moonfield__data"] = None
+        self.__dict__.update(state)
+
+    @_instrumented("randomFill", lambda args, result: _pixels(args[0]))
+    def randomFill(self, low=0, high=mod-1, seed=None):
         """Fill the moonfield with random values in the range min..max
-        inclusive. WARNING: NOT GOOD FOR REAL CRYPTO USE. Use a
-        cryptographically strong RNG instead of the library's unless you're
-        just playing around."""
+        inclusive, each equally likely. The randomness comes from the
+        operating system's cryptographically strong RNG or, if a seed
+        string is given, from a keystream determined by it (see
+        randomBitmap())."""
 
-        def randomFiller(x,y, low=low, high=high):
-            return random.randint(low, high)
+        values = _randomIntegers(self.__xmax*self.__ymax, low, high, seed)
+        self.fill(values.reshape(self.__ymax, self.__xmax))
 
-        self.fill(randomFiller)
-
-    def imageComplement(self, img):
+    @_instrumented("imageComplement", lambda args, result: _pixels(args[0]))
+    def imageComplement(self, img, into=None):
         """Precondition: self must have been filled already. Take a
         greyscale image (PIL type "L"), which must have the same size as
         self. Return a new moonfield such that, if that new moonfield and
         the current one were superimposed, one would "see" the supplied
         image. NB: if the supplied image parameter is a string, an attempt
-        is made to open the file of that name."""
-
-        if type(img) == type(""):
-            img = Image.open(img).convert("L")
-        assert self.size() == img.size
-        result = moonfield(size=(self.__xmax, self.__ymax))
-        def filler(x,y,i=img, d=self.__data, pi=self.discretePi, m=self.mod):
-            return (d[(x,y)] - (pi - i.getpixel((x,y)))) % m
-        result.fill(filler)
+        is made to open the file of that name. If into, a moonfield of the
+        same size, is given, the result goes in there instead of into a new
+        moonfield (into may even be self, if the pad is no longer needed)
+        and into is returned."""
+
+        pixels = _greyPixels(img)
+        assert pixels.shape == (self.__ymax, self.__xmax)
+        if into is None:
+            into = moonfield(self.size())
+        assert into.size() == self.size()
+        return into.__complementOf(self.__complementBase(), pixels)
+
+    @_instrumented("imageComplement",
+                   lambda args, result: _pixels(args[0]) * len(result))
+    def imageComplements(self, images):
+        """Same as imageComplement() for each of a list of images, all of
+        the same size as self, against this one pad. Return the list of the
+        resulting moonfields. The part of the sum that only depends on the
+        pad is worked out once for all the images."""
+
+        base = self.__complementBase()
+        result = []
+        for img in images:
+            pixels = _greyPixels(img)
+            assert pixels.shape == (self.__ymax, self.__xmax)
+            result.append(moonfield(self.size()).__complementOf(base, pixels))
         return result
 
+    def __complementBase(self):
+        """Return (d - pi) modulo mod for each angle d of self, as an array
+        of unsigned 16-bit integers."""
+
+        base = self.__data + (self.mod - self.discretePi)
+        numpy.remainder(base, self.mod, base)
+        return base
+
+    def __complementOf(self, base, pixels):
+        """Fill self with (base + pixels) modulo mod, i.e. the complement of
+        the greyscale pixels against the pad whose base is supplied (see
+        __complementBase()). Return self."""
+
+        if self.__data is None:
+            self.__data = numpy.empty(base.shape, numpy.uint16)
+            if _collectors:
+                _noteAllocation(self.__data, 0)
+        numpy.add(base, pixels, self.__data)
+        numpy.remainder(self.__data, self.mod, self.__data)
+        return self
+
+    @_instrumented("renderOnCanvas", lambda args, result: _pixels(args[0]))
     def renderOnCanvas(self, canvas, radius=moonfieldViewer.R):
         """Take a canvas and render the moonfield on it. The radius of the
         halfmoons must be specified in canvas units."""
@@ -441,7 +1706,7 @@ class moonfield:
                 # Make the halfmoon at x,y
                 canvas.create_arc(
                     radius*2*x, radius*2*y, radius*2*(x+1)-1, radius*2*(y+1)-1,
-                    start = self.__data[(x,y)] * self.i2d, extent = 180.0,
+                    start = self.__data[y, x] * self.i2d, extent = 180.0,
                     fill="Black")
 
     def view(self, root, title="No name", radius=moonfieldViewer.R):
@@ -454,113 +1719,1684 @@ class moonfield:
 
         return moonfieldViewer(root, self, title, radius)
 
+    @_instrumented("writeMoonfield", lambda args, result: _pixels(args[0]))
+    def write(self, filename):
+        """Write this moonfield, as black halfmoons, to a file with the
+        given filename, scaled to fit an A4 page. File type is deduced from
+        the extension: .ps or .eps for PostScript, .pdf for PDF. No window
+        is needed (unlike psprint() on a viewer). Precondition: the
+        moonfield must be filled."""
+
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in (".ps", ".eps"):
+            _writeMoonfieldPS(self, filename)
+        elif ext == ".pdf":
+            _writeMoonfieldPDF(self, filename)
+        else:
+            raise ValueError, "can only write moonfields as PS or PDF, " \
+                  "not " + filename
+
+    def rasterize(self, radius=moonfieldViewer.R, mode="1"):
+        """Return a bitmap of this moonfield drawn as black halfmoons of the
+        given radius in pixels (so each cell becomes a square of 2*radius
+        pixels a side, as on a viewer's canvas) or, if mode is "L", the
+        same as a PIL greyscale image (black 0, white 255). To see what
+        superimposing two moonfields would look like, OR the bitmaps, or
+        take the darker of the images (ImageChops.darker()). Precondition:
+        the moonfield must be filled."""
+
+        if mode not in ("1", "L"):
+            raise ValueError, "can't rasterize to mode " + repr(mode)
+        stamps = _halfmoonStamps(radius)
+        side = 2*radius
+        width, height = side*self.__xmax, side*self.__ymax
+        if mode == "L":
+            result = numpy.empty((height, width), numpy.uint8)
+        else:
+            result = numpy.empty((height, _rowBytes(width)), numpy.uint8)
+        rows = _bandRows(self.__xmax*side*side)
+        for y0 in range(0, self.__ymax, rows):
+            y1 = min(y0 + rows, self.__ymax)
+            # One stamp per cell, then lay the stamps out side by side.
+            cells = stamps[self.__data[y0:y1]].transpose(0, 2, 1, 3)
+            pixels = cells.reshape((y1 - y0)*side, width)
+            if mode == "L":
+                result[y0*side:y1*side] = (pixels ^ 1) * 255
+            else:
+                result[y0*side:y1*side] = numpy.packbits(pixels, axis=1)
+        if mode == "L":
+            return Image.fromarray(result, "L")
+        return bitmap((width, height), result)
+
     def __repr__(self):
-        if self.__data == {}:
+        if self.__data is None:
             return "<uninitialised>"
         result = ""
         for y in range(self.__ymax):
             for x in range(self.__xmax):
-                result = result + "%3d " % self.__data[(x,y)]
+                result = result + "%3d " % self.__data[y, x]
             result = result + "\n"
         return result
 
-    def dump(self, filename):
+    def dump(self, filename, bits=9, compress=1):
         """Dump yourself to a file in the internal .mfd format (another
-        moonfield object can later be made from such a file)."""
-
-        pickle.dump(self, open(filename, "w"))
+        moonfield object can later be made from such a file, see
+        moonfield_undump()). The angles are stored in 9 bits each, or in 16
+        if bits is 16, and compressed with zlib if compress is true. Only
+        uncompressed 16-bit files can be mapped into memory when read
+        back; the default gives the smallest files."""
+
+        if bits not in (9, 16):
+            raise ValueError, "bits must be 9 or 16, not %s" % bits
+        flags = 0
+        if compress:
+            flags = flags | _mfdCompressed
+        if self.__data is None:
+            flags = flags | _mfdEmpty
+        f = open(filename, "wb")
+        try:
+            f.write(struct.pack(_mfdHeader, _mfdMagic, _mfdVersion, bits,
+                                flags, 0, self.__xmax, self.__ymax))
+            if self.__data is not None:
+                compressor = zlib.compressobj(6)
+                for chunk in _packAngles(self.__data, bits):
+                    if compress:
+                        chunk = compressor.compress(chunk)
+                    f.write(chunk)
+                if compress:
+                    f.write(compressor.flush())
+        finally:
+            f.close()
+
+    def _adopt(self, data):
+        """Make the given NumPy array of angles, indexed by [y, x], this
+        moonfield's own without copying it (for moonfield_undump() and
+        tiledEngine)."""
+
+        assert data.shape == (self.__ymax, self.__xmax)
+        self.__data = data
+        if _collectors:
+            _noteAllocation(data, 0)
+
+def _greyPixels(img):
+    """Take a greyscale image (PIL type "L", or anything PIL can convert to
+    that, or the name of a file holding one) and return its pixels as a
+    NumPy array of unsigned bytes indexed by [y, x]."""
+
+    if type(img) == type(""):
+        img = Image.open(img)
+    if img.mode != "L":
+        img = img.convert("L")
+    width, height = img.size
+    return numpy.fromstring(img.tobytes(), numpy.uint8).reshape(height, width)
+
+# Direct PostScript and PDF output for moonfields, without going through a
+# Tk canvas. The geometry is the same as the one psprint() aims for: the
+# portrait A4 page is, in mm, WxH=210x297; with a safety margin of 7mm all
+# around it, the usable area becomes 196x283, and the moonfield is scaled
+# to fit it and centred on the page.
+
+_pointsPerMm = 72 / 25.4
+
+def _pageLayout(size):
+    """Take the size of a moonfield and return a triple with the position,
+    in points from the SW corner of an A4 page, of the SW corner of the
+    moonfield and the diameter of a halfmoon, also in points."""
 
-def moonfield_undump(filename):
+    xmax, ymax = size
+    pageW, pageH = 210 * _pointsPerMm, 297 * _pointsPerMm
+    usableW, usableH = 196 * _pointsPerMm, 283 * _pointsPerMm
+    cell = min(usableW / max(1, xmax), usableH / max(1, ymax))
+    return (pageW - cell*xmax) / 2, (pageH - cell*ymax) / 2, cell
+
+def _writeMoonfieldPS(mf, filename):
+    """Write the moonfield mf to the named file as PostScript. The halfmoon
+    is a procedure, m, that takes the angle (in moonfield units) and draws
+    the halfmoon for the next cell along the current row, so each cell
+    costs only a few bytes; the procedure r moves on to the next row."""
+
+    xmax, ymax = mf.size()
+    x0, y0, cell = _pageLayout(mf.size())
+    f = open(filename, "w")
+    f.write("%!PS-Adobe-3.0\n")
+    f.write("%%%%BoundingBox: %d %d %d %d\n" % (
+        int(x0), int(y0), int(x0 + cell*xmax + 1), int(y0 + cell*ymax + 1)))
+    f.write("%%Creator: VCK\n%%Pages: 1\n%%EndComments\n")
+    f.write("/d %r def\n" % moonfield.i2d)
+    f.write("/m {x y moveto x y .5 4 -1 roll d mul dup 180 add arc\n"
+            " closepath fill /x x 1 add def} bind def\n")
+    f.write("/r {/x .5 def /y y 1 sub def} bind def\n")
+    f.write("%%Page: 1 1\n")
+    f.write("gsave %f %f translate %f dup scale\n" % (x0, y0, cell))
+    f.write("/y %d.5 def\n" % ymax)
+    data = mf.data()
+    for y in range(ymax):
+        f.write("r\n")
+        angles = data[y].tolist()
+        for x in range(0, xmax, 16):
+            f.write(string.join(["%d m" % a for a in angles[x:x+16]], " "))
+            f.write("\n")
+    f.write("grestore showpage\n%%EOF\n")
+    f.close()
+
+def _writeMoonfieldPDF(mf, filename):
+    """Write the moonfield mf to the named file as a single page PDF. PDF
+    has no arcs, so the halfmoon is drawn once, with Bezier curves, as a
+    form that each cell then places with the appropriate rotation. The page
+    content is compressed as it is generated."""
+
+    xmax, ymax = mf.size()
+    x0, y0, cell = _pageLayout(mf.size())
+    # The halfmoon of diameter 1 centred on the origin, from 0 to 180
+    # degrees; k is the usual Bezier approximation of a quarter circle.
+    r = 0.5
+    k = 0.5523 * r
+    halfmoon = ("%g 0 m %g %g %g %g 0 %g c %g %g %g %g %g 0 c h f" %
+                (r, r, k, k, r, r, -k, r, -r, k, -r))
+    # The rotation for each possible angle, ready to be formatted.
+    rotations = []
+    for a in range(moonfield.mod):
+        radians = a * moonfield.i2d * numpy.pi / 180
+        c, s = numpy.cos(radians), numpy.sin(radians)
+        rotations.append("%.4f %.4f %.4f %.4f" % (c, s, -s, c))
+
+    f = open(filename, "wb")
+    offsets = {}
+    def startObject(n, f=f, offsets=offsets):
+        offsets[n] = f.tell()
+        f.write("%d 0 obj\n" % n)
+
+    f.write("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    startObject(1)
+    f.write("<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+    startObject(2)
+    f.write("<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n")
+    startObject(3)
+    f.write("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f]\n"
+            "/Resources << /XObject << /H 5 0 R >> >> /Contents 4 0 R >>\n"
+            "endobj\n" % (210 * _pointsPerMm, 297 * _pointsPerMm))
+
+    # The content stream, whose length is only known at the end and so
+    # goes in an object of its own.
+    startObject(4)
+    f.write("<< /Length 6 0 R /Filter /FlateDecode >>\nstream\n")
+    start = f.tell()
+    compressor = zlib.compressobj()
+    f.write(compressor.compress("%f 0 0 %f %f %f cm\n" % (
+        cell, cell, x0 + cell/2, y0 + cell/2)))
+    data = mf.data()
+    for y in range(ymax):
+        row = ymax - 1 - y
+        lines = ["q %s %d %d cm /H Do Q\n" % (rotations[a], x, row)
+                 for x, a in enumerate(data[y].tolist())]
+        f.write(compressor.compress(string.join(lines, "")))
+    f.write(compressor.flush())
+    length = f.tell() - start
+    f.write("\nendstream\nendobj\n")
+
+    startObject(5)
+    f.write("<< /Type /XObject /Subtype /Form /BBox [-0.5 -0.5 0.5 0.5]\n"
+            "/Length %d >>\nstream\n%s\nendstream\nendobj\n" %
+            (len(halfmoon), halfmoon))
+    startObject(6)
+    f.write("%d\nendobj\n" % length)
+
+    xref = f.tell()
+    f.write("xref\n0 7\n0000000000 65535 f \n")
+    for n in range(1, 7):
+        f.write("%010d 00000 n \n" % offsets[n])
+    f.write("trailer\n<< /Size 7 /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % xref)
+    f.close()
+
+# The halfmoons for each of the moonfield.mod possible angles, as arrays of
+# 0 (paper) and 1 (ink) indexed by [angle, y, x], cached by radius. They
+# take 4*radius*radius bytes per angle, so only the _stampCacheSize radii
+# used most recently are kept.
+_stampCache = collections.OrderedDict()
+_stampCacheSize = 4
+
+def _halfmoonStamps(radius):
+    """Return the halfmoon stamps (see _stampCache) for the given radius in
+    pixels, making them if necessary. A pixel is inked if its centre is
+    within the disc and no more than 180 degrees anticlockwise from the
+    angle of the halfmoon, like the arcs drawn by renderOnCanvas()."""
+
+    if radius in _stampCache:
+        stamps = _stampCache.pop(radius)
+    else:
+        centres = numpy.arange(2*radius) + 0.5 - radius
+        dy, dx = centres[:, None], centres[None, :]
+        inDisc = dx*dx + dy*dy <= radius*radius
+        angles = numpy.arange(moonfield.mod) * moonfield.i2d * numpy.pi / 180
+        c = numpy.cos(angles)[:, None, None]
+        s = numpy.sin(angles)[:, None, None]
+        # Screen y goes down, hence -dy for the anticlockwise side.
+        onSide = c*(-dy) - s*dx >= 0
+        stamps = (inDisc & onSide).astype(numpy.uint8)
+    _stampCache[radius] = stamps
+    while len(_stampCache) > _stampCacheSize:
+        _stampCache.popitem(0)
+    return stamps
+
+# The .mfd format of dumped moonfields. A 16 byte header, in network byte
+# order, made of:
+#     - the magic string _mfdMagic,
+#     - the version of the format (1 byte),
+#     - the bits per angle, 9 or 16 (1 byte),
+#     - flags (1 byte): _mfdCompressed if the angles are compressed with
+#       zlib, _mfdEmpty if the moonfield is uninitialised and there are no
+#       angles at all,
+#     - a reserved byte (0),
+#     - the width and height (4 bytes each),
+# followed by the angles, row by row from the NW corner. 16-bit angles are
+# little-endian unsigned integers; 9-bit ones are packed one after the
+# other, most significant bit first, with the last byte padded with 0s.
+# Older versions of the kit pickled the moonfield object instead, which is
+# slow, big and unsafe to load from a file of unknown origin.
+_mfdMagic = "\x89MFD"
+_mfdVersion = 1
+_mfdHeader = ">4sBBBBII"
+_mfdCompressed = 1
+_mfdEmpty = 2
+
+def _mfdBands(width, height):
+    """Return the (first, last+1) row ranges into which the angles of a
+    moonfield of the given size are packed and unpacked: about _bandBytes
+    of angles each and a multiple of 8 rows, so that 9-bit bands start on
+    a byte boundary."""
+
+    rows = max(8, _bandRows(2*width) // 8 * 8)
+    return [(y, min(y + rows, height)) for y in range(0, height, rows)]
+
+def _packAngles(data, bits):
+    """Return an iterator over the angles in data (see moonfield.data()),
+    as strings of the bytes of successive bands of rows in the given
+    number of bits each."""
+
+    height, width = data.shape
+    for y0, y1 in _mfdBands(width, height):
+        band = data[y0:y1]
+        if bits == 16:
+            yield band.astype("<u2").tostring()
+        else:
+            pairs = band.astype(">u2").reshape(-1, 1).view(numpy.uint8)
+            yield numpy.packbits(numpy.unpackbits(pairs, axis=1)[:, 7:]) \
+                  .tostring()
+
+def _unpackAngles(payload, size, bits):
+    """The inverse of _packAngles: take the string of all the packed angles
+    of a moonfield of the given size and return them as a NumPy array of
+    unsigned 16-bit integers indexed by [y, x]."""
+
+    width, height = size
+    if len(payload) < (width*height*bits + 7) // 8:
+        raise IOError, "truncated .mfd file"
+    if bits == 16:
+        data = numpy.frombuffer(payload, "<u2", width*height)
+        data = data.reshape(height, width).astype(numpy.uint16)
+    else:
+        data = numpy.empty((height, width), numpy.uint16)
+        weights = 1 << numpy.arange(8, -1, -1).astype(numpy.uint16)
+        for y0, y1 in _mfdBands(width, height):
+            count = (y1 - y0) * width * 9
+            start = y0 * width * 9 // 8
+            chunk = numpy.frombuffer(payload, numpy.uint8, (count + 7) // 8,
+                                     start)
+            angles = numpy.unpackbits(chunk)[:count].reshape(-1, 9)
+            data[y0:y1] = angles.dot(weights).reshape(y1 - y0, width)
+    if data.size and data.max() >= moonfield.mod:
+        raise ValueError, "corrupt .mfd file: angle out of range"
+    return data
+
+def moonfield_undump(filename, mmap=0, allowPickle=0):
     """Return a moonfield obtained by rebuilding the one that had been
-    dumped to the given file."""
+    dumped to the given file (see moonfield.dump()). If mmap is true and
+    the file is uncompressed with 16-bit angles, they are mapped into
+    memory, read-only, instead of being read in, so that only the parts
+    used are ever read from the disc. Files pickled by older versions of
+    the kit are refused unless allowPickle is true, since unpickling a file
+    can run arbitrary code: only allow it for files you made yourself, or
+    better still convert them once and for all with
+    moonfield_convert()."""
+
+    f = open(filename, "rb")
+    try:
+        header = f.read(struct.calcsize(_mfdHeader))
+        if header[:len(_mfdMagic)] != _mfdMagic:
+            if not allowPickle:
+                raise ValueError, filename + " is not an .mfd file (if it " \
+                      "is an old pickled moonfield you trust, convert it " \
+                      "with moonfield_convert())"
+            f.seek(0)
+            return pickle.load(f)
+        if len(header) < struct.calcsize(_mfdHeader):
+            raise IOError, "truncated .mfd file"
+        magic, version, bits, flags, reserved, width, height = \
+               struct.unpack(_mfdHeader, header)
+        if version > _mfdVersion or bits not in (9, 16):
+            raise ValueError, "%s: unsupported .mfd file (version %d, " \
+                  "%d bits)" % (filename, version, bits)
+        result = moonfield((width, height))
+        if flags & _mfdEmpty:
+            return result
+        if mmap and bits == 16 and not flags & _mfdCompressed:
+            if width*height:
+                data = numpy.memmap(filename, "<u2", "r", len(header),
+                                    (height, width))
+                result._adopt(data)
+                return result
+        payload = f.read()
+        if flags & _mfdCompressed:
+            payload = zlib.decompress(payload)
+        result._adopt(_unpackAngles(payload, (width, height), bits))
+        return result
+    finally:
+        f.close()
+
+def moonfield_convert(oldFile, newFile=None, bits=9, compress=1):
+    """Convert a moonfield pickled by an older version of the kit into an
+    .mfd file (by default, the same file), with the options of
+    moonfield.dump(). Only do this for files you trust: the old format is
+    unpickled to read it. Return the moonfield."""
+
+    result = moonfield_undump(oldFile, allowPickle=1)
+    result.dump(newFile or oldFile, bits, compress)
+    return result
+# --------------------------------------------------------------
+# Verification
+
+# Checking shares by eye doesn't scale to a print run, so here is what it
+# takes to check them by program: superimpose any set of shares (bitmaps,
+# or moonfields, which are drawn as halfmoons first), measure how dark
+# each block of subpixels coming from one pixel of the plaintext turned
+# out, and see whether that matches the plaintext; and check that each
+# share on its own looks the same whatever the plaintext was.
+
+def blockSums(bmp, side):
+    """Take a bitmap and return a NumPy array, indexed by [y, x], of the
+    number of black pixels in each of its side x side blocks (any pixels
+    left over at the right and bottom edges are ignored)."""
+
+    width, height = bmp.size()
+    columns, rows = width // side, height // side
+    bits = bmp.buffer()
+    result = numpy.empty((rows, columns), numpy.int32)
+    step = max(1, _bandRows(width) // side)
+    for b0 in range(0, rows, step):
+        b1 = min(b0 + step, rows)
+        pixels = numpy.unpackbits(bits[b0*side:b1*side], axis=1)
+        pixels = pixels[:, :columns*side].reshape(b1 - b0, side, columns, side)
+        result[b0:b1] = pixels.sum(axis=3, dtype=numpy.int32).sum(axis=1)
+    return result
+
+def blockPatterns(bmp, side):
+    """Like blockSums(), but return for each block the number whose bits,
+    most significant first, are its pixels row by row: i.e. which of the
+    2**(side*side) possible patterns it is."""
+
+    width, height = bmp.size()
+    columns, rows = width // side, height // side
+    bits = bmp.buffer()
+    weights = 1 << numpy.arange(side*side - 1, -1, -1).astype(numpy.int64)
+    result = numpy.empty((rows, columns), numpy.int64)
+    step = max(1, _bandRows(width) // side)
+    for b0 in range(0, rows, step):
+        b1 = min(b0 + step, rows)
+        pixels = numpy.unpackbits(bits[b0*side:b1*side], axis=1)
+        pixels = pixels[:, :columns*side].reshape(b1 - b0, side, columns, side)
+        pixels = pixels.transpose(0, 2, 1, 3).reshape(b1 - b0, columns, -1)
+        result[b0:b1] = pixels.dot(weights)
+    return result
+
+class superposition:
+    """A set of shares superimposed, as on the overhead projector. The
+    shares may be bitmaps, lazyBitmaps or moonfields (drawn as halfmoons
+    of the given radius), and must all come out the same size. What gets
+    worked out is kept, so asking again costs nothing."""
+
+    # Private members:
+    # __shares = the list of shares
+    # __radius = the radius for drawing moonfields
+    # __stack = None until worked out, then the bitmap of the shares ORed
+    # __darkness = dictionary from block side to the array of the darkness
+    #              of each block (from 0, white, to 1, black)
+
+    def __init__(self, shares, radius=None):
+        self.__shares = list(shares)
+        self.__radius = radius or moonfieldViewer.R
+        self.__stack = None
+        self.__darkness = {}
+
+    def raster(self, share):
+        """Return the given share as a bitmap, as it is superimposed."""
+
+        if isinstance(share, moonfield):
+            return share.rasterize(self.__radius)
+        if isinstance(share, lazyBitmap):
+            return share.evaluate()
+        return share
+
+    def stack(self):
+        """Return the bitmap of the shares superimposed."""
+
+        if self.__stack is None:
+            self.__stack = OR(*[self.raster(s) for s in self.__shares])
+        return self.__stack
+
+    def darkness(self, side):
+        """Return a NumPy array, indexed by [y, x], of the fraction of black
+        pixels in each side x side block of the stack."""
+
+        if side not in self.__darkness:
+            self.__darkness[side] = \
+                blockSums(self.stack(), side) / float(side*side)
+        return self.__darkness[side]
+
+def _inkiness(plaintext):
+    """Return the plaintext (a bitmap, or a greyscale image or its filename)
+    as a NumPy array, indexed by [y, x], of how much ink each pixel should
+    have: 0 for white and 1 for black; and whether it is a bitmap."""
+
+    if isinstance(plaintext, lazyBitmap):
+        plaintext = plaintext.evaluate()
+    if isinstance(plaintext, bitmap):
+        width = plaintext.size()[0]
+        pixels = numpy.unpackbits(plaintext.buffer(), axis=1)[:, :width]
+        return pixels.astype(float), 1
+    return 1 - _greyPixels(plaintext) / 255.0, 0
+
+def _distance(values, groups):
+    """Return the total variation distance between the distributions of the
+    values (small integers, 0 or more) in the two groups (boolean mask and
+    its complement) and the distance below which it is compatible with
+    chance."""
+
+    first, second = values[groups], values[~groups]
+    if not len(first) or not len(second):
+        return 0.0, 1.0
+    bins = int(values.max()) + 1
+    p = numpy.bincount(first, minlength=bins) / float(len(first))
+    q = numpy.bincount(second, minlength=bins) / float(len(second))
+    # Two samples of the same distribution over k values typically differ
+    # by well under sqrt(k * (1/n1 + 1/n2)) / 2.
+    kinds = ((p > 0) | (q > 0)).sum()
+    tolerance = numpy.sqrt(kinds * (1.0/len(first) + 1.0/len(second)))
+    return float(0.5 * abs(p - q).sum()), float(min(1.0, tolerance))
+
+@_instrumented("checkShares", lambda args, result: _pixels(result["size"]))
+def checkShares(shares, plaintext, radius=None):
+    """Superimpose the shares (see superposition) and compare the result
+    with the plaintext (a bitmap, or for moonfields a greyscale image or
+    its filename), each pixel of which must have become a square block of
+    the stack. Return a dictionary with:
+        "size": the size of the plaintext;
+        "side": the side of the blocks;
+        "correlation": between the darkness of the blocks and the ink of
+            the plaintext (near 1 for a good reconstruction);
+        "contrast", "rmsError": the slope and the root mean square error of
+            the straight line that best predicts darkness from ink;
+    and, for a bitmap plaintext, also:
+        "black", "white": the mean darkness of the blocks of black and of
+            white pixels;
+        "darkestWhite", "lightestBlack": the extremes, which must not
+            overlap ("separable") for every pixel to be readable;
+        "errorRate": the fraction of pixels read wrongly when blocks darker
+            than halfway between "white" and "black" are taken as black;
+    and "shares", a list of dictionaries, one per share, checking that the
+    share on its own gives nothing away: "distance" is the total variation
+    distance between the distributions of its blocks (patterns of
+    subpixels, or angles of moonfields) over the black (or darker than
+    median) pixels and over the others, and "independent" says whether
+    that is below "tolerance", i.e. compatible with chance."""
+
+    ink, binary = _inkiness(plaintext)
+    height, width = ink.shape
+    view = superposition(shares, radius)
+    stackWidth, stackHeight = view.stack().size()
+    side = stackWidth // width
+    if side * width != stackWidth or side * height != stackHeight:
+        raise ValueError, "the shares (%dx%d) aren't a whole number of " \
+              "times the size of the plaintext (%dx%d)" % (
+              stackWidth, stackHeight, width, height)
+    darkness = view.darkness(side)
+    report = {"size": (width, height), "side": side}
+
+    # Least squares, by hand (polyfit is slow on millions of points).
+    x = ink.ravel() - ink.mean()
+    y = darkness.ravel() - darkness.mean()
+    sxx, syy, sxy = x.dot(x), y.dot(y), x.dot(y)
+    slope, correlation = 0.0, 0.0
+    if sxx > 0:
+        slope = sxy / sxx
+        if syy > 0:
+            correlation = sxy / numpy.sqrt(sxx * syy)
+    report["correlation"] = float(correlation)
+    report["contrast"] = float(slope)
+    report["rmsError"] = float(numpy.sqrt(max(0, syy - slope*sxy) / len(y)))
+
+    if binary:
+        black, white = ink > 0.5, ink <= 0.5
+        groups = black
+        if black.any() and white.any():
+            report["black"] = float(darkness[black].mean())
+            report["white"] = float(darkness[white].mean())
+            report["lightestBlack"] = float(darkness[black].min())
+            report["darkestWhite"] = float(darkness[white].max())
+            report["separable"] = bool(
+                report["lightestBlack"] > report["darkestWhite"])
+            threshold = (report["black"] + report["white"]) / 2
+            report["errorRate"] = float(
+                ((darkness > threshold) != black).mean())
+    else:
+        groups = ink > numpy.median(ink)
+
+    report["shares"] = []
+    for share in shares:
+        if isinstance(share, moonfield):
+            values = share.data() * 30 // moonfield.mod
+        elif side*side <= 16:
+            values = blockPatterns(view.raster(share), side)
+        else:
+            values = blockSums(view.raster(share), side)
+        distance, tolerance = _distance(values[:height, :width], groups)
+        report["shares"].append({"distance": distance,
+                                 "tolerance": tolerance,
+                                 "independent": distance <= tolerance})
+    return report
+
+
+# --------------------------------------------------------------
+# Parallel execution
+
+# With processes, a tiledEngine's pool lives as long as the engine, so the
+# arrays of each operation can't reach the workers by being inherited when
+# they are forked. Instead they are put in files in shared memory (/dev/shm
+# where there is one), which both sides map; what is sent to the workers
+# with each tile is just the description of the operation, with each array
+# replaced by a _sharedArray saying where to map it.
+
+class _sharedArray:
+    """Describes an array held in a file that several processes map."""
+
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = shape
+        self.dtype = numpy.dtype(dtype).str
+
+    def map(self):
+        return numpy.memmap(self.filename, self.dtype, "r+", 0, self.shape)
+
+def _tileWorker(job):
+    """Run a job, i.e. a state and a (first, last+1) range of rows, in a
+    worker process, mapping the shared arrays of the state."""
+
+    def mapped(value):
+        if isinstance(value, _sharedArray):
+            return value.map()
+        return value
+
+    state, rows = job
+    state = state.copy()
+    for key, value in state.items():
+        if isinstance(value, list):
+            state[key] = [mapped(v) for v in value]
+        else:
+            state[key] = mapped(value)
+    _runTile(state, rows)
+
+def _runTile(state, job):
+    """Carry out the operation described by the dictionary state on the
+    range of rows job = (first, last+1), writing into state["out"]. Every
+    tile gives the same result no matter which worker runs it or when."""
+
+    y0, y1 = job
+    out = state["out"]
+    kind = state["kind"]
+    if kind == "boolean":
+        inputs, operation = state["inputs"], state["operation"]
+        band = out[y0:y1]
+        band[...] = inputs[0][y0:y1]
+        for other in inputs[1:]:
+            operation(band, other[y0:y1], band)
+        _clearPadding(band, state["width"])
+    elif kind == "pixelcode":
+        out[2*y0:2*y1] = state["scheme"].expand(
+            state["bits"][y0:y1], state["width"], y0)
+    elif kind == "random":
+        rowBytes = out.shape[1]
+        band = _randomBytes((y1 - y0)*rowBytes, state["seed"], y0*rowBytes)
+        out[y0:y1] = band.reshape(y1 - y0, rowBytes)
+        _clearPadding(out[y0:y1], state["width"])
+    elif kind == "complement":
+        band = out[y0:y1]
+        numpy.add(state["pad"][y0:y1], state["offset"], band)
+        numpy.add(band, state["pixels"][y0:y1], band)
+        numpy.remainder(band, moonfield.mod, band)
+    else:
+        raise ValueError, "unknown kind of tile: " + kind
+
+class tiledEngine:
+    """Runs the whole-picture operations of the kit on several processors
+    at once, by splitting the pictures into bands of rows (tiles) and
+    handing them out to a pool of threads or of processes. The results are
+    identical to those of the ordinary functions, seeded random ones
+    included, since each tile of a seeded pad takes its own stretch of the
+    keystream. The pool is started the first time it is needed and kept
+    until close() is called. With processes, the inputs and results are
+    shared with the workers through files in shared memory, so nothing the
+    size of a picture is ever pickled."""
+
+    def __init__(self, workers=None, processes=0, tileRows=None):
+        """Take the number of workers (by default, one per processor),
+        whether they should be processes rather than threads (threads are
+        cheaper to start and are enough when, as here, most of the time is
+        spent in NumPy with the interpreter lock released) and optionally
+        the number of rows per tile (by default, enough tiles to give each
+        worker a few)."""
+
+        self.__workers = workers or multiprocessing.cpu_count()
+        self.__processes = processes
+        self.__tileRows = tileRows
+        self.__pool = None
+
+    def close(self):
+        """Stop the workers. The engine can still be used afterwards: a new
+        pool is started if need be."""
+
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __tiles(self, height):
+        """Return the list of row ranges the work is split into."""
+
+        rows = self.__tileRows
+        if not rows:
+            rows = max(1, -(-height // (4*self.__workers)))
+        return [(y, min(y + rows, height)) for y in range(0, height, rows)]
+
+    def __shared(self, shape, dtype, files):
+        """Return a new array in shared memory and its _sharedArray, adding
+        the name of the file holding it to the list files (to be removed
+        once the workers are done with it; the parent's mapping outlives
+        the name)."""
+
+        directory = None
+        if os.path.isdir("/dev/shm"):
+            directory = "/dev/shm"
+        handle, filename = tempfile.mkstemp(prefix="vck-tile",
+                                            dir=directory)
+        os.close(handle)
+        files.append(filename)
+        array = numpy.memmap(filename, dtype, "w+", 0, shape)
+        return array, _sharedArray(filename, shape, dtype)
+
+    def __run(self, state, height, outShape, outDtype):
+        """Run the operation described by state over all the tiles of a
+        picture of the given height, into a new array of the given shape
+        and type, and return that array."""
+
+        jobs = self.__tiles(height)
+        if self.__workers == 1 or len(jobs) <= 1 or 0 in outShape:
+            state["out"] = numpy.empty(outShape, outDtype)
+            for job in jobs:
+                _runTile(state, job)
+            return state["out"]
+        if self.__pool is None:
+            if self.__processes:
+                self.__pool = multiprocessing.Pool(self.__workers)
+            else:
+                self.__pool = multiprocessing.pool.ThreadPool(self.__workers)
+        if not self.__processes:
+            state["out"] = numpy.empty(outShape, outDtype)
+            self.__pool.map(lambda job, state=state: _runTile(state, job),
+                            jobs, 1)
+            return state["out"]
+
+        files = []
+        try:
+            out, state["out"] = self.__shared(outShape, outDtype, files)
+            for key, value in state.items():
+                if isinstance(value, numpy.ndarray):
+                    state[key] = self.__share(value, files)
+                elif isinstance(value, list):
+                    state[key] = [self.__share(v, files) for v in value]
+            self.__pool.map(_tileWorker, [(state, job) for job in jobs], 1)
+        finally:
+            for filename in files:
+                os.remove(filename)
+        return out
+
+    def __share(self, array, files):
+        """Return a _sharedArray holding a copy of the given array."""
+
+        copy, shared = self.__shared(array.shape, array.dtype, files)
+        copy[...] = array
+        return shared
+
+    def boolean(self, operation, bitmaps):
+        """Same as the boolean() function, for NumPy bitwise ufuncs."""
+
+        size = width, height = bitmaps[0].size()
+        for b in bitmaps[1:]:
+            assert b.size() == size
+        out = self.__run({"kind": "boolean", "width": width,
+                          "operation": operation,
+                          "inputs": [b.buffer() for b in bitmaps]}, height,
+                         bitmaps[0].buffer().shape, numpy.uint8)
+        return bitmap(size, out)
+
+    def AND(self, *args): return self.boolean(numpy.bitwise_and, args)
+    def OR(self, *args): return self.boolean(numpy.bitwise_or, args)
+    def XOR(self, *args): return self.boolean(numpy.bitwise_xor, args)
+
+    def pixelcode(self, bmp, scheme=None):
+        """Same as bmp.pixelcode(scheme)."""
+
+        width, height = bmp.size()
+        out = self.__run({"kind": "pixelcode", "width": width,
+                          "bits": bmp.buffer(),
+                          "scheme": scheme or diagonalScheme}, height,
+                         (2*height, _rowBytes(2*width)), numpy.uint8)
+        return bitmap((2*width, 2*height), out)
+
+    def randomBitmap(self, size, seed=None):
+        """Same as the randomBitmap() function."""
+
+        width, height = size
+        out = self.__run({"kind": "random", "width": width, "seed": seed},
+                         height, (height, _rowBytes(width)), numpy.uint8)
+        return bitmap(size, out)
+
+    def imageComplement(self, pad, img):
+        """Same as pad.imageComplement(img)."""
+
+        pixels = _greyPixels(img)
+        xmax, ymax = pad.size()
+        assert pixels.shape == (ymax, xmax)
+        out = self.__run({"kind": "complement", "pad": pad.data(),
+                          "pixels": pixels,
+                          "offset": moonfield.mod - moonfield.discretePi},
+                         ymax, (ymax, xmax), numpy.uint16)
+        result = moonfield(pad.size())
+        result._adopt(out)
+        return result
 
-    return pickle.load(open(filename))
 # --------------------------------------------------------------
 # File-based mode of operation
 
-def makePad(size, expandedPadFile="pad.tif", dumpFile="rawpad.pbm"):
-    """Generate a random pad. (NB: remember that the RNG used here is only
-    good for demos since it's not cryptographically strong!) Write out two
-    files with the supplied names, one with the dump of the pad in raw form
-    (necessary for encrypting later, to be kept at the agency) and one with
-    the pad in expanded form, ready for use, to be given to 007. Return the
-    raw and expanded bitmaps."""
+# Raw pads are long-lived and many messages may be encrypted with each, so
+# the pads read by makeCryptograph() and makeCryptographG() are kept, along
+# with the pixelcoded versions of the monochrome ones, in a process-wide
+# cache: the padCache called pads. A file is recognised by its path, its
+# modification time, its size and its inode, so a pad that is rewritten
+# is read again; the functions here that write pads also tell the cache.
+
+class padCache:
+    """A cache of raw pads read from files (bitmaps and moonfields) and of
+    pixelcoded bitmap pads, holding at most a given number of bytes and
+    throwing out the least recently used entries to make room. It is safe
+    to use from several threads."""
+
+    # Private members:
+    # __entries = OrderedDict from key to (value, bytes), least recently
+    #             used first; the key is (kind, path, stamp[, scheme])
+    # __bytes = the total bytes of the values in __entries
+    # __lock = a lock guarding all of the above and the statistics
+    # __hits, __misses, __evictions = the statistics
+
+    def __init__(self, maxBytes=256*1024*1024):
+        """Make an empty cache that will hold up to maxBytes bytes of pads
+        (which can be changed later through the maxBytes attribute)."""
+
+        self.maxBytes = maxBytes
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__hits = self.__misses = self.__evictions = 0
+
+    def __stamp(self, filename):
+        path = os.path.abspath(filename)
+        s = os.stat(path)
+        return path, (s.st_mtime, s.st_size, s.st_ino)
+
+    def __lookup(self, key, make):
+        """Return the value cached under key, making it with make() (which
+        returns the value and its size in bytes) if it isn't there."""
+
+        self.__lock.acquire()
+        try:
+            if key in self.__entries:
+                self.__hits = self.__hits + 1
+                entry = self.__entries.pop(key)
+                self.__entries[key] = entry
+                return entry[0]
+            self.__misses = self.__misses + 1
+        finally:
+            self.__lock.release()
+
+        # Made outside the lock, so that other threads aren't held up;
+        # two threads may make the same value at once, which is harmless.
+        value, bytes = make()
+        self.__lock.acquire()
+        try:
+            if bytes <= self.maxBytes and key not in self.__entries:
+                # Any entry for an older version of the same file is stale.
+                self.__discard(lambda k: k[:2] == key[:2] and k[2] != key[2])
+                self.__entries[key] = (value, bytes)
+                self.__bytes = self.__bytes + bytes
+                while self.__bytes > self.maxBytes:
+                    oldest, (_, size) = self.__entries.popitem(0)
+                    self.__bytes = self.__bytes - size
+                    self.__evictions = self.__evictions + 1
+        finally:
+            self.__lock.release()
+        return value
+
+    def __discard(self, condition):
+        for key in self.__entries.keys():
+            if condition(key):
+                self.__bytes = self.__bytes - self.__entries.pop(key)[1]
+
+    def __padBytes(self, path):
+        """Return how many bytes the raw bitmap pad in the named file takes
+        up once loaded, from the header of the file alone."""
+
+        f = open(path, "rb")
+        try:
+            try:
+                width, height = _readPBMHeader(f)
+            except IOError:
+                # PIL reads no more than the header until asked to.
+                width, height = Image.open(path).size
+        finally:
+            f.close()
+        return height * _rowBytes(width)
+
+    def pad(self, filename):
+        """Return the raw bitmap pad in the named file, as a bitmap. One
+        too big for the cache is not cached, and is mapped into memory (see
+        mapBitmap()) if it can be, so that only what is used of it is
+        read."""
+
+        path, stamp = self.__stamp(filename)
+        if self.__padBytes(path) > self.maxBytes:
+            return _loadPad(path)
+        def make(path=path):
+            # Copy a memory-mapped pad: the file may be rewritten under it.
+            raw = _loadPad(path)
+            bits = numpy.array(raw.buffer())
+            return bitmap(raw.size(), bits), bits.nbytes
+        return self.__lookup(("pad", path, stamp), make)
+
+    def expanded(self, filename, scheme=None):
+        """Return the raw bitmap pad in the named file pixelcoded with the
+        given subpixelScheme (diagonalScheme by default), or None if it
+        would be too big to cache."""
+
+        if scheme is None:
+            scheme = diagonalScheme
+        path, stamp = self.__stamp(filename)
+        if 4 * self.__padBytes(path) > self.maxBytes:
+            return None
+        def make(path=path, scheme=scheme):
+            # Pixelcoded straight from the file: the raw pad isn't wanted,
+            # and caching it too would only take room from other pads.
+            result = _loadPad(path).pixelcode(scheme)
+            return result, result.buffer().nbytes
+        return self.__lookup(("expanded", path, stamp, scheme), make)
+
+    def moonfield(self, filename):
+        """Return the raw greyscale pad in the named .mfd file, as a
+        moonfield. Don't change it: it is shared."""
+
+        path, stamp = self.__stamp(filename)
+        def make(path=path):
+            result = moonfield_undump(path)
+            data = result.data()
+            return result, data is not None and data.nbytes or 0
+        return self.__lookup(("moonfield", path, stamp), make)
+
+    def invalidate(self, filename=None):
+        """Forget everything cached from the named file or, if no filename
+        is given, everything."""
+
+        self.__lock.acquire()
+        try:
+            if filename is None:
+                self.__entries.clear()
+                self.__bytes = 0
+            else:
+                path = os.path.abspath(filename)
+                self.__discard(lambda k: k[1] == path)
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """Return a dictionary with the number of hits, misses and
+        evictions so far and the number of entries and bytes held now."""
+
+        self.__lock.acquire()
+        try:
+            return {"hits": self.__hits, "misses": self.__misses,
+                    "evictions": self.__evictions,
+                    "entries": len(self.__entries), "bytes": self.__bytes,
+                    "maxBytes": self.maxBytes}
+        finally:
+            self.__lock.release()
+
+pads = padCache()
+
+def makePad(size, expandedPadFile="pad.tif", dumpFile="rawpad.pbm",
+            scheme=None):
+    """Generate a random pad. Write out two files with the supplied names,
+    one with the dump of the pad in raw form (necessary for encrypting
+    later, to be kept at the agency) and one with the pad in expanded form,
+    ready for use, to be given to 007. The optional subpixelScheme is the
+    one to pixelcode with; the cryptographs must later use the same. Return
+    the raw and expanded bitmaps."""
 
     rawPad = randomBitmap(size)
     rawPad.write(dumpFile)
-    expandedPad = rawPad.pixelcode()
+    pads.invalidate(dumpFile)
+    expandedPad = rawPad.pixelcode(scheme)
     expandedPad.write(expandedPadFile)
     return rawPad, expandedPad
 
-def makeCryptograph(imageFile, codedFile="coded.tif", dumpFile="rawpad.pbm"):
+@_instrumented("makeCryptograph", lambda args, result: _pixels(result) // 4)
+def makeCryptograph(imageFile, codedFile="coded.tif", dumpFile="rawpad.pbm",
+                    scheme=None, padOrigin=None, usePadCache=1):
     """Generate a cryptograph. Take a monochrome image (the filename of a
-    PIL type "1") and a file with a dump of a raw pad (Precondition: image
-    and raw pad must be of the same size in pixels.)  Write out the
-    cryptograph as an image file. Return the bitmap for the cryptograph."""
-
-    pad = bitmap(dumpFile)
-    plaintext = bitmap(imageFile)
-    ciphertext = XOR(pad, plaintext)
-    expandedCiphertext = ciphertext.pixelcode()
+    PIL type "1", or a bitmap), a file with a dump of a raw pad (which must
+    be of the same size in pixels) and optionally the subpixelScheme the
+    pad was pixelcoded with. Write out the cryptograph as an image file.
+    Return the bitmap for the cryptograph. If padOrigin, an (x, y) pair, is
+    given, the pad may be bigger than the image and the part of it used is
+    the one of the image's size with its NW corner at padOrigin; this
+    allows one big pad to serve many messages, but each message MUST use a
+    different part of it or the pad stops being a one-time pad. Raise
+    ValueError if the image doesn't fit in the pad there. The pad and its pixelcoded version are taken from the
+    pads cache (see padCache) unless usePadCache is false or the pad is
+    too big for it; then a raw PBM pad is mapped into memory rather than
+    decoded, so only the part being used is ever read."""
+
+    # Pixelcoding the XOR of plaintext and pad gives the same as XORing
+    # the pixelcoded pad with the plaintext blown up by solidScheme, and
+    # only the latter needs the pixelcoded pad, which can be cached.
+    if isinstance(imageFile, bitmap):
+        plaintext = imageFile
+    else:
+        plaintext = bitmap(imageFile)
+    width, height = plaintext.size()
+    x, y = padOrigin or (0, 0)
+    expandedPad = None
+    if usePadCache:
+        expandedPad = pads.expanded(dumpFile, scheme)
+    if expandedPad is None:
+        expandedPad = lazy(_loadPad(dumpFile)).pixelcode(scheme)
+    padWidth, padHeight = expandedPad.size()
+    padWidth, padHeight = padWidth // 2, padHeight // 2
+    if x < 0 or y < 0 or x + width > padWidth or y + height > padHeight:
+        raise ValueError, "a %dx%d image at (%d, %d) doesn't fit in the " \
+              "%dx%d pad %s" % (width, height, x, y, padWidth, padHeight,
+                                dumpFile)
+    expandedPad = expandedPad.crop((2*x, 2*y, 2*(x + width), 2*(y + height)))
+    expandedCiphertext = XOR(expandedPad,
+                             lazy(plaintext).pixelcode(solidScheme)).evaluate()
     expandedCiphertext.write(codedFile)
     return expandedCiphertext
 
-def splitImage(image, shareFile1="share1.tif", shareFile2="share2.tif"):
+def splitImage(image, shareFile1="share1.tif", shareFile2="share2.tif",
+               scheme=None, halftoneMethod=None):
     """Not for spies, really, just for cute demos. Take a monochrome image
     (a PIL type "1" or its filename) and produce two image files that, when
-    superimposed, will yield the image. Return the bitmaps for the two
-    shares."""
-
-    _, expandedPad = makePad(Image.open(image).size, shareFile1)
-    expandedCiphertext = makeCryptograph(image, shareFile2)
+    superimposed, will yield the image. The optional subpixelScheme says
+    how to pixelcode the shares. If a halftoneMethod (see halftone()) is
+    given, the image may be greyscale and is halftoned by that method
+    first. Return the bitmaps for the two shares."""
+
+    if halftoneMethod:
+        image = halftone(image, halftoneMethod)
+        size = image.size()
+    else:
+        size = Image.open(image).size
+    # The pad is used just this once, so it is kept out of the pads cache.
+    _, expandedPad = makePad(size, shareFile1, scheme=scheme)
+    expandedCiphertext = makeCryptograph(image, shareFile2, scheme=scheme,
+                                         usePadCache=0)
     return expandedPad, expandedCiphertext
 
-# And same again for greyscale... Note that here we HAVE to use windows,
-# even if we want to run in batch mode, because without drawing the stuff
-# on the canvas we can't generate the postscript (actually, seeing how
-# messy it is to get the margins to come out right, I'm thinking that I
-# perhaps ought to generate the postscript by hand, without any canvas,
-# like I used to do in the old, deprecated C++ version of VCK...)
+def splitImageThreshold(image, k=3, n=5, shareFiles="share%d.tif",
+                        seed=None):
+    """Like splitImage, but take the filename of a monochrome image and
+    split it into n shares any k of which, superimposed, yield the image
+    (see thresholdScheme). shareFiles is a pattern for the filenames of the
+    shares, with %d standing for their number, from 1. Return the bitmaps
+    for the shares."""
+
+    shares = thresholdScheme(k, n).split(bitmap(image), seed)
+    for i in range(n):
+        shares[i].write(shareFiles % (i+1))
+    return shares
+
+# Batch mode: split many images at once, in memory, over a pool of worker
+# processes, each of which decodes, encrypts and encodes whole images so
+# that the disc and the processors are kept busy at the same time.
+
+def _imageList(sources):
+    """Take a source of images, or a list of them, and return the list of
+    image filenames they stand for. A source is either a directory (all
+    the files in it that PIL recognises by their extension, in alphabetical
+    order), a glob pattern, a manifest file (a .txt or .lst file with one
+    filename per line; blank lines and lines starting with # are ignored,
+    relative names are relative to the manifest) or an image filename."""
+
+    if type(sources) != type([]) and type(sources) != type(()):
+        sources = [sources]
+    Image.init()
+    known = Image.EXTENSION
+    result = []
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.splitext(name)[1].lower() in known and \
+                   os.path.isfile(path):
+                    result.append(path)
+        elif glob.has_magic(source):
+            result.extend(sorted(glob.glob(source)))
+        elif os.path.splitext(source)[1].lower() in (".txt", ".lst"):
+            base = os.path.dirname(source)
+            for line in open(source).readlines():
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    result.append(os.path.join(base, line))
+        else:
+            result.append(source)
+    return result
+
+def _splitOne(job):
+    """Split one image for splitImages(). Take (image, shareFile1,
+    shareFile2, scheme) and return a dictionary describing what was done
+    (or what went wrong, under "error"), for the manifest."""
+
+    image, shareFile1, shareFile2, scheme = job
+    record = {"image": image, "share1": shareFile1, "share2": shareFile2}
+    start = time.time()
+    try:
+        plaintext = bitmap(image)
+        ciphertext, pad = encryptFused(plaintext, None, scheme)
+        pad.write(shareFile1)
+        ciphertext.write(shareFile2)
+        record["size"] = plaintext.size()
+    except Exception, e:
+        # Whatever it was (an assertion, a decompression bomb, running out
+        # of memory on a huge picture), it's this image's problem only.
+        record["error"] = "%s: %s" % (e.__class__.__name__, e)
+    record["seconds"] = time.time() - start
+    return record
+
+def splitImages(sources, outputDir, scheme=None, workers=None, ext=None,
+                manifest="manifest.json"):
+    """Same as splitImage() for each of the images given by sources (see
+    _imageList() for what these can be), but all in one go, with a pad made
+    up in memory for each image and no raw pad files written. The shares of
+    image foo.tif go to outputDir as foo_1.tif and foo_2.tif (or with the
+    extension ext, if given); if several images have the same name, all
+    but the first get a number added to it (foo-2_1.tif and so on). The
+    images are shared out among workers processes (one per processor by
+    default). A failure on one image is recorded and doesn't stop the
+    others. Write a JSON manifest, listing for each image its shares, size
+    and processing time or error, to the file of that name in outputDir
+    (unless manifest is None), and return the same list of dictionaries."""
+
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    jobs = []
+    used = {}
+    for image in _imageList(sources):
+        base, imageExt = os.path.splitext(os.path.basename(image))
+        shareExt = ext or imageExt
+        # Don't let images with the same name from different places (or
+        # with different extensions) overwrite each other's shares.
+        name = base
+        while used.has_key(name + shareExt):
+            used[base + shareExt] = used[base + shareExt] + 1
+            name = "%s-%d" % (base, used[base + shareExt])
+        used[name + shareExt] = 1
+        base = name
+        jobs.append((image,
+                     os.path.join(outputDir, base + "_1" + shareExt),
+                     os.path.join(outputDir, base + "_2" + shareExt),
+                     scheme))
+
+    if workers == 1 or len(jobs) < 2:
+        records = map(_splitOne, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            records = pool.map(_splitOne, jobs, 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if manifest:
+        f = open(os.path.join(outputDir, manifest), "w")
+        json.dump(records, f, indent=1, sort_keys=True)
+        f.close()
+    return records
+
+# Streaming versions of the above, for pictures too big to hold in memory:
+# the files are read, processed and written a band of rows at a time, so
+# memory use doesn't depend on the height of the picture. Input is only
+# truly streamed from raw PBM files (other formats are handed to PIL, which
+# decodes them whole); output can be raw PBM or uncompressed TIFF.
+
+def _readPBMHeader(f):
+    """Take a file open on a raw (P4) PBM file, positioned at the start.
+    Read the header and return the (width, height) of the picture, leaving
+    the file positioned at the first byte of the packed rows. Raise IOError
+    if this isn't a raw PBM file."""
+
+    if f.read(2) != "P4":
+        raise IOError, "not a raw PBM file"
+    numbers = []
+    c = f.read(1)
+    while len(numbers) < 2:
+        if c == "#":
+            while c not in "\r\n":
+                c = f.read(1)
+        elif c.isdigit():
+            digits = ""
+            while c.isdigit():
+                digits = digits + c
+                c = f.read(1)
+            numbers.append(int(digits))
+            continue
+        elif not c.isspace():
+            raise IOError, "bad raw PBM header"
+        c = f.read(1)
+    # Exactly one whitespace character separates header and data, and we
+    # have just read it.
+    if not c.isspace():
+        raise IOError, "bad raw PBM header"
+    return tuple(numbers)
+
+def mapBitmap(filename):
+    """Return a bitmap whose pixels are those of the given raw PBM file,
+    mapped into memory rather than read: nothing is actually read until
+    the pixels are used, and then only the pages that are needed, so that
+    taking a small crop() of a huge pad is cheap. The bitmap is read-only;
+    operations on it yield ordinary new bitmaps. Raise IOError if the file
+    isn't raw PBM."""
+
+    f = open(filename, "rb")
+    try:
+        size = width, height = _readPBMHeader(f)
+        offset = f.tell()
+    finally:
+        f.close()
+    shape = (height, _rowBytes(width))
+    if 0 in shape:
+        return bitmap(size)
+    bits = numpy.memmap(filename, numpy.uint8, "r", offset, shape)
+    if width % 8 and (bits[:, -1] & ~_padMask(width) & 0xff).any():
+        # Some other program left junk in the padding, which the rest of
+        # the kit relies on being clear: give up on mapping.
+        bits = numpy.array(bits)
+        _clearPadding(bits, width)
+    return bitmap(size, bits)
+
+def _loadPad(filename):
+    """Return a bitmap for the raw pad in the given file, mapped into
+    memory if possible, decoded by PIL otherwise."""
+
+    try:
+        return mapBitmap(filename)
+    except IOError:
+        return bitmap(filename)
+
+class _bandReader:
+    """Reads a bitmap file a band of packed rows at a time (in bitmap's
+    internal representation)."""
+
+    def __init__(self, filename):
+        self.__file = open(filename, "rb")
+        self.__bits = None
+        try:
+            self.__size = _readPBMHeader(self.__file)
+        except IOError:
+            # Not raw PBM: let PIL decode the whole thing.
+            self.__file.close()
+            self.__file = None
+            whole = bitmap(filename)
+            self.__size = whole.size()
+            self.__bits = whole.buffer()
+        self.__row = 0
+
+    def size(self):
+        """Return a 2-tuple (width, height) in pixels."""
+        return self.__size
+
+    def read(self, rows):
+        """Return the next rows rows (fewer at the end of the picture)."""
+
+        width, height = self.__size
+        rows = min(rows, height - self.__row)
+        if self.__file is None:
+            band = self.__bits[self.__row:self.__row+rows]
+        else:
+            rowBytes = _rowBytes(width)
+            data = self.__file.read(rows*rowBytes)
+            if len(data) != rows*rowBytes:
+                raise IOError, "truncated raw PBM file"
+            band = numpy.fromstring(data, numpy.uint8).reshape(rows, rowBytes)
+            _clearPadding(band, width)
+        self.__row = self.__row + rows
+        return band
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+
+class _pbmWriter:
+    """Writes a raw PBM file a band of packed rows at a time. Handily, PBM
+    has the same idea as bitmap of what a set bit means (black)."""
+
+    def __init__(self, filename, size):
+        self.__file = open(filename, "wb")
+        self.__file.write("P4\n%d %d\n" % size)
+
+    def write(self, band):
+        """Append a band of packed rows."""
+        self.__file.write(band.tostring())
+
+    def close(self):
+        self.__file.close()
+
+class _tiffWriter:
+    """Writes an uncompressed bilevel TIFF file a band of packed rows at a
+    time, each band becoming a strip. All bands but the last must have the
+    same number of rows. The directory goes at the end of the file, once
+    the positions of all the strips are known."""
+
+    def __init__(self, filename, size):
+        self.__file = open(filename, "wb")
+        self.__size = size
+        self.__offsets = []
+        self.__counts = []
+        self.__rowsPerStrip = None
+        # Little-endian header; the directory offset is patched in later.
+        self.__file.write("II*\0\0\0\0\0")
+
+    def write(self, band):
+        """Append a band of packed rows as a new strip."""
+
+        if self.__rowsPerStrip is None:
+            self.__rowsPerStrip = band.shape[0]
+        self.__offsets.append(self.__file.tell())
+        self.__counts.append(band.size)
+        self.__file.write(band.tostring())
+
+    def close(self):
+        f = self.__file
+        width, height = self.__size
+        if f.tell() % 2:
+            f.write("\0")
+        # The resolution (72 dpi, as PIL assumes) and the strip tables are
+        # too big to fit in their directory entries, so they go first.
+        resolution = f.tell()
+        f.write(struct.pack("<2I", 72, 1))
+        offsets = f.tell()
+        f.write(struct.pack("<%dI" % len(self.__offsets), *self.__offsets))
+        counts = f.tell()
+        f.write(struct.pack("<%dI" % len(self.__counts), *self.__counts))
+        strips = len(self.__offsets)
+        if strips == 1:
+            # A single value is stored in the directory entry itself.
+            offsets, counts = self.__offsets[0], self.__counts[0]
+        SHORT, LONG, RATIONAL = 3, 4, 5
+        entries = [
+            (256, LONG, 1, width),
+            (257, LONG, 1, height),
+            (258, SHORT, 1, 1),                 # BitsPerSample
+            (259, SHORT, 1, 1),                 # Compression: none
+            (262, SHORT, 1, 0),                 # Photometric: WhiteIsZero
+            (273, LONG, strips, offsets),       # StripOffsets
+            (277, SHORT, 1, 1),                 # SamplesPerPixel
+            (278, LONG, 1, self.__rowsPerStrip or height),
+            (279, LONG, strips, counts),        # StripByteCounts
+            (282, RATIONAL, 1, resolution),     # XResolution
+            (283, RATIONAL, 1, resolution),     # YResolution
+            (296, SHORT, 1, 2),                 # ResolutionUnit: inch
+            ]
+        directory = f.tell()
+        f.write(struct.pack("<H", len(entries)))
+        for tag, kind, count, value in entries:
+            f.write(struct.pack("<HHII", tag, kind, count, value))
+        f.write(struct.pack("<I", 0))
+        f.seek(4)
+        f.write(struct.pack("<I", directory))
+        f.close()
+
+def _bandWriter(filename, size):
+    """Return a band writer (see _pbmWriter) for a file of the given name,
+    whose type is deduced from the extension."""
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in (".pbm", ".pnm"):
+        return _pbmWriter(filename, size)
+    if ext in (".tif", ".tiff"):
+        return _tiffWriter(filename, size)
+    raise ValueError, "can only stream to PBM or TIFF files, not " + filename
+
+def _streamEncrypt(plaintext, padSource, padFile, expandedPadFile, codedFile,
+                   scheme):
+    """The engine behind the streaming functions. Take a _bandReader for
+    the plaintext (or None, to make a pad only) and either a _bandReader for
+    the raw pad or, if None, make the pad up on the spot. Write the raw pad,
+    the pixelcoded pad and the pixelcoded ciphertext, a band at a time, to
+    those of the given files that aren't None."""
+
+    if scheme is None:
+        scheme = diagonalScheme
+    if plaintext is not None:
+        size = plaintext.size()
+    else:
+        size = padSource.size()
+    width, height = size
+    expandedSize = (2*width, 2*height)
+    writers = []
+    rawWriter = expandedWriter = codedWriter = None
+    if padFile:
+        rawWriter = _bandWriter(padFile, size)
+        writers.append(rawWriter)
+    if expandedPadFile:
+        expandedWriter = _bandWriter(expandedPadFile, expandedSize)
+        writers.append(expandedWriter)
+    if codedFile:
+        codedWriter = _bandWriter(codedFile, expandedSize)
+        writers.append(codedWriter)
+
+    rowBytes = _rowBytes(width)
+    rows = _bandRows(4*rowBytes)
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        if isinstance(padSource, _bandReader):
+            padBand = padSource.read(y1 - y0)
+        else:
+            padBand = _randomBytes((y1-y0)*rowBytes).reshape(y1-y0, rowBytes)
+            _clearPadding(padBand, width)
+        if rawWriter:
+            rawWriter.write(padBand)
+        if expandedWriter:
+            expandedWriter.write(scheme.expand(padBand, width, y0))
+        if codedWriter:
+            cipherBand = numpy.bitwise_xor(plaintext.read(y1 - y0), padBand)
+            codedWriter.write(scheme.expand(cipherBand, width, y0))
+    for w in writers:
+        w.close()
+
+class _sizeOnly:
+    """Stands in for a _bandReader when all that's needed is the size."""
+
+    def __init__(self, size):
+        self.__size = size
+
+    def size(self):
+        return self.__size
+
+def makePadStream(size, expandedPadFile="pad.tif", dumpFile="rawpad.pbm",
+                  scheme=None):
+    """Same as makePad(), but a band at a time without ever holding the
+    whole pad in memory, and therefore returning nothing. The files must be
+    PBM or TIFF."""
+
+    _streamEncrypt(None, _sizeOnly(size), dumpFile, expandedPadFile, None,
+                   scheme)
+    pads.invalidate(dumpFile)
+
+def makeCryptographStream(imageFile, codedFile="coded.tif",
+                          dumpFile="rawpad.pbm", scheme=None):
+    """Same as makeCryptograph(), but a band at a time without ever holding
+    the whole pictures in memory, and therefore returning nothing. The
+    output file must be PBM or TIFF and the input files ought to be raw
+    PBM, since anything else gets decoded whole by PIL."""
+
+    plaintext = _bandReader(imageFile)
+    pad = _bandReader(dumpFile)
+    try:
+        assert plaintext.size() == pad.size()
+        _streamEncrypt(plaintext, pad, None, None, codedFile, scheme)
+    finally:
+        plaintext.close()
+        pad.close()
+
+def splitImageStream(image, shareFile1="share1.tif", shareFile2="share2.tif",
+                     scheme=None):
+    """Same as splitImage(), but a band at a time without ever holding the
+    whole pictures in memory, and therefore returning nothing. The image
+    ought to be a raw PBM file (anything else gets decoded whole by PIL)
+    and the shares must be PBM or TIFF. Since the pad is used as it is
+    made, no raw pad file is written."""
+
+    plaintext = _bandReader(image)
+    try:
+        _streamEncrypt(plaintext, _sizeOnly(plaintext.size()), None,
+                       shareFile1, shareFile2, scheme)
+    finally:
+        plaintext.close()
+
+def decryptStream(ciphertextFile, padFile, resultFile="decrypted.tif"):
+    """Same as decrypt(), but working on files a band at a time without
+    ever holding the whole pictures in memory. The result file must be PBM
+    or TIFF and the input files ought to be raw PBM, since anything else
+    gets decoded whole by PIL."""
+
+    ciphertext = _bandReader(ciphertextFile)
+    pad = _bandReader(padFile)
+    try:
+        assert ciphertext.size() == pad.size()
+        width, height = ciphertext.size()
+        result = _bandWriter(resultFile, (width, height))
+        rows = _bandRows(_rowBytes(width))
+        for y0 in range(0, height, rows):
+            n = min(rows, height - y0)
+            result.write(numpy.bitwise_or(ciphertext.read(n), pad.read(n)))
+        result.close()
+    finally:
+        ciphertext.close()
+        pad.close()
+
+# Incremental re-encryption: when only small parts of a plaintext change
+# (say the serial number on a form that is otherwise always the same), the
+# cryptograph needn't be made again from scratch. Only the pixels in the
+# changed rectangles are worked out again and written over the old ones in
+# the raw PBM file of the cryptograph, which is mapped into memory so that
+# nothing else is read or written. NB: re-encrypting part of a picture
+# with the same pad is only safe if the old cryptograph is destroyed:
+# anyone who sees both can tell where, and how, the two plaintexts differ.
+
+def _runs(flags, gap):
+    """Take a 1-d array of booleans and return a list of (first, last+1)
+    ranges covering its true elements, merging ranges fewer than gap
+    elements apart."""
+
+    indices = numpy.flatnonzero(flags)
+    if len(indices) == 0:
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(indices) > gap)
+    starts = indices[numpy.concatenate(([0], breaks + 1))]
+    ends = indices[numpy.concatenate((breaks, [len(indices) - 1]))] + 1
+    return zip(starts.tolist(), ends.tolist())
+
+def dirtyRectangles(previous, plaintext, gap=64):
+    """Take two bitmaps of the same size and return a list of boxes (as in
+    bitmap.crop()) that between them cover every pixel in which they
+    differ, leaving out as much as possible of what is the same. Changes
+    fewer than gap pixels apart go in the same box. The boxes are aligned
+    to bytes horizontally (their left edges are multiples of 8)."""
+
+    width, height = size = plaintext.size()
+    assert previous.size() == size
+    old, new = previous.buffer(), plaintext.buffer()
+    boxes = []
+    for y0, y1 in _bands(new):
+        changed = old[y0:y1] != new[y0:y1]
+        for top, bottom in _runs(changed.any(1), gap):
+            columns = changed[top:bottom].any(0)
+            for left, right in _runs(columns, max(1, gap // 8)):
+                boxes.append((8*left, y0 + top, min(8*right, width),
+                              y0 + bottom))
+    return boxes
+
+def _openBitmap(image):
+    """Return a bitmap for image, which is either one already or the name
+    of a file (mapped into memory if it's raw PBM)."""
+
+    if isinstance(image, bitmap):
+        return image
+    return _loadPad(image)
+
+@_instrumented("updateCryptograph", lambda args, result:
+               sum([(r - l)*(b - t) for l, t, r, b in result]))
+def updateCryptograph(imageFile, codedFile="coded.pbm", dumpFile="rawpad.pbm",
+                      boxes=None, previous=None, scheme=None, padOrigin=None):
+    """Bring up to date a cryptograph made by makeCryptograph() (with the
+    same dumpFile, scheme and padOrigin) after the plaintext has changed.
+    Take the new plaintext (a filename or a bitmap) and either a list of
+    boxes (as in bitmap.crop()) outside which it hasn't changed, or the
+    previous plaintext, from which dirtyRectangles() finds them; with
+    neither, the whole picture is done. Rewrite the pixels of the
+    cryptograph that those boxes turn into, in place in codedFile, which
+    must be a raw PBM file. Return the list of boxes, widened to whole
+    bytes, that were done."""
+
+    if scheme is None:
+        scheme = diagonalScheme
+    plaintext = _openBitmap(imageFile)
+    pad = _loadPad(dumpFile)
+    width, height = plaintext.size()
+    padWidth, padHeight = pad.size()
+    x, y = padOrigin or (0, 0)
+    assert x + width <= padWidth and y + height <= padHeight
+
+    if boxes is None:
+        if previous is None:
+            boxes = [(0, 0, width, height)]
+        else:
+            boxes = dirtyRectangles(_openBitmap(previous), plaintext)
+    f = open(codedFile, "rb")
+    try:
+        codedSize = _readPBMHeader(f)
+        offset = f.tell()
+    finally:
+        f.close()
+    if codedSize != (2*width, 2*height):
+        raise IOError, "%s is %dx%d, not twice the size of the plaintext" % (
+            (codedFile,) + codedSize)
+
+    # As in makeCryptograph(), the pixelcoded pad gets XORed with the
+    # plaintext blown up by solidScheme. A scheme with a single pattern
+    # pixelcodes each pixel the same wherever it is, so just the box of the
+    # pad is pixelcoded; otherwise the patterns depend on where the pixels
+    # are in the whole pad, so whole rows of it are, and then cropped.
+    positional = len(scheme.patterns()) > 1
+    coded = None
+    done = []
+    for left, top, right, bottom in boxes:
+        left, top = max(0, left) & ~7, max(0, top)
+        right, bottom = min(width, (right + 7) & ~7), min(height, bottom)
+        if left >= right or top >= bottom:
+            continue
+        if positional:
+            rows = pad.crop((0, y + top, padWidth, y + bottom)).buffer()
+            expandedPad = bitmap((2*padWidth, 2*(bottom - top)),
+                                 scheme.expand(rows, padWidth, y + top))
+            expandedPad = expandedPad.crop(
+                (2*(x + left), 0, 2*(x + right), 2*(bottom - top))).buffer()
+        else:
+            rows = pad.crop((x + left, y + top, x + right, y + bottom))
+            expandedPad = scheme.expand(rows.buffer(), right - left)
+        rows = plaintext.crop((left, top, right, bottom)).buffer()
+        expanded = numpy.bitwise_xor(
+            expandedPad, solidScheme.expand(rows, right - left))
+        if coded is None:
+            coded = numpy.memmap(codedFile, numpy.uint8, "r+", offset,
+                                 (2*height, _rowBytes(2*width)))
+        # left is a multiple of 8 and right either that or the right edge,
+        # so the box covers whole bytes of the cryptograph, which can be
+        # written over without disturbing any pixels outside it.
+        first = left // 4
+        coded[2*top:2*bottom, first:first + expanded.shape[1]] = expanded
+        done.append((left, top, right, bottom))
+    if coded is not None:
+        coded.flush()
+        del coded
+    return done
+
+# And same again for greyscale... These used to HAVE to use windows, even
+# in batch mode, because the postscript was generated by drawing the stuff
+# on a canvas. Now moonfields can write their own postscript (or PDF), so
+# if you pass None instead of Tk's root window, no window is made and the
+# viewers returned are None.
 
 def makePadG(root, size, expandedPadFile="pad.ps", dumpFile="rawpad.mfd"):
-    """Generate a random pad. (NB: remember that the RNG used here is only
-    good for demos since it's not cryptographically strong!) Write out two
-    files with the supplied names, one with the dump of the pad in raw form
-    (necessary for encrypting later, to be kept at the agency) and one with
-    the pad in expanded form, ready for use, to be given to 007. Return a
-    pair made of the moonfield for the pad and a viewer on it."""
+    """Generate a random pad. Write out two files with the supplied names,
+    one with the dump of the pad in raw form (necessary for encrypting
+    later, to be kept at the agency) and one with the pad in expanded form,
+    ready for use, to be given to 007. Return a pair made of the moonfield
+    for the pad and a viewer on it (None if root is None)."""
 
     raw = moonfield(size)
     raw.randomFill()
     raw.dump(dumpFile)
-    v = raw.view(root)
-    v.psprint(expandedPadFile)
-    return raw, v
+    pads.invalidate(dumpFile)
+    return raw, _writeG(root, raw, expandedPadFile)
 
-def makeCryptographG(root, image, codedFile="coded.ps", dumpFile="rawpad.mfd"):
+def makeCryptographG(root, image, codedFile="coded.ps", dumpFile="rawpad.mfd",
+                     usePadCache=1):
     """Generate a cryptograph. Take an image (either a PIL image of type
     "L" or a filename) and a file with a dump of a raw pad moonfield
     (Precondition: image and raw pad must be of the same size in pixels.)
-    Write out the cryptograph as a postscript file of halfmoons. Return a
-    pair made of the moonfield for the cryptograph and a viewer on it."""
-
-    pad = moonfield_undump(dumpFile)
+    Write out the cryptograph as a postscript (or PDF, depending on the
+    extension) file of halfmoons. Return a pair made of the moonfield for
+    the cryptograph and a viewer on it (None if root is None). The pad is
+    taken from the pads cache (see padCache) unless usePadCache is
+    false."""
+
+    if usePadCache:
+        pad = pads.moonfield(dumpFile)
+    else:
+        pad = moonfield_undump(dumpFile)
     ciphertext = pad.imageComplement(image)
-    v = ciphertext.view(root)
-    v.psprint(codedFile)
-    return ciphertext, v
+    return ciphertext, _writeG(root, ciphertext, codedFile)
+
+def _writeG(root, mf, filename):
+    """Write the moonfield mf to the named file, either headlessly or, if
+    root is not None, through a viewer, which is then returned."""
+
+    if root is None:
+        mf.write(filename)
+        return None
+    v = mf.view(root)
+    v.psprint(filename)
+    return v
 
 def splitImageG(root, image, shareFile1="share1.ps", shareFile2="share2.ps"):
     """Not for spies, really, just for cute demos. Take a greyscale image
     (either an "L" image object or a filename) and produce two postscript
-    files of halfmoons that, when superimposed, will yield the
+    (or PDF) files of halfmoons that, when superimposed, will yield the
     image. Return a quadruple made of the two shares and two viewers
-    showing them."""
+    showing them (None if root is None)."""
 
     if type(image) == type(""):
         image = Image.open(image).convert("L")
     p, v1 = makePadG(root, image.size, shareFile1)
-    c, v2 = makeCryptographG(root, image, shareFile2)
+    c, v2 = makeCryptographG(root, image, shareFile2, usePadCache=0)
     return p, c, v1, v2
 
 # --------------------------------------------------------------
@@ -682,6 +3518,34 @@ def testSplitImageG(root):
     v2.psprint("guido-decrypted.ps")
     return v2
 
+def testUpdateCryptograph(root):
+    """Encrypt a random plaintext, change it, bring the cryptograph up to
+    date with updateCryptograph() for boxes that don't fall on byte
+    boundaries and check that the result is byte for byte what encrypting
+    the changed plaintext from scratch gives, for a scheme with a single
+    pattern and one with several, with and without a pad origin."""
+
+    for scheme in (diagonalScheme, naorShamirScheme()):
+        makePad((93, 41), "update-pad.tif", "update-rawpad.pbm", scheme)
+        for origin in (None, (5, 3)):
+            previous = randomBitmap((40, 20))
+            plaintext = bitmap((40, 20), previous.buffer().copy())
+            boxes = [(3, 2, 10, 6), (13, 9, 14, 19), (33, 0, 39, 20)]
+            for left, top, right, bottom in boxes:
+                for x in range(left, right):
+                    for y in range(top, bottom):
+                        plaintext.set(x, y, 1 - plaintext.get(x, y))
+            makeCryptograph(previous, "update-coded.pbm", "update-rawpad.pbm",
+                            scheme, origin)
+            expected = makeCryptograph(plaintext, "update-expected.pbm",
+                                       "update-rawpad.pbm", scheme, origin)
+            updateCryptograph(plaintext, "update-coded.pbm",
+                              "update-rawpad.pbm", boxes, None, scheme,
+                              origin)
+            assert open("update-coded.pbm", "rb").read() == \
+                   open("update-expected.pbm", "rb").read()
+    return [bitmap("update-coded.pbm").view(root, "updated cryptograph")]
+
 if __name__ == "__main__":
 #    mainApp(testBooleanOps)
     mainApp(testEncryptDecrypt)
@@ -689,3 +3553,4 @@ if __name__ == "__main__":
 #    mainApp(testGrey)
 #    mainApp(testSplitImage)
 #    mainApp(testSplitImageG)
+#    mainApp(testUpdateCryptograph)